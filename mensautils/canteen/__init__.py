@@ -0,0 +1 @@
+default_app_config = 'mensautils.canteen.apps.CanteenConfig'
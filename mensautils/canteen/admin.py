@@ -2,7 +2,7 @@ from django.contrib import admin
 
 from mensautils.canteen.models import Dish, Canteen, Serving, Rating, \
     InofficialDeprecation, ServingVerification, Notification, \
-    CanteenUserConfig, OpeningTime
+    CanteenUserConfig, OpeningTime, FetchState, DishStatistics, OutgoingMail
 
 admin.site.register(Dish)
 admin.site.register(Canteen)
@@ -13,3 +13,6 @@ admin.site.register(Notification)
 admin.site.register(Serving)
 admin.site.register(ServingVerification)
 admin.site.register(Rating)
+admin.site.register(FetchState)
+admin.site.register(DishStatistics)
+admin.site.register(OutgoingMail)
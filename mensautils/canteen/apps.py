@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
-class BaseConfig(AppConfig):
-    name = 'base'
+class CanteenConfig(AppConfig):
+    name = 'mensautils.canteen'
+    label = 'canteen'
+
+    def ready(self):
+        # register signal handlers
+        from mensautils.canteen import signals  # noqa: F401
+
+        from mensautils.parser import soup
+        soup.BACKEND = getattr(settings, 'HTML_PARSER', soup.BACKEND)
@@ -1,62 +1,190 @@
+from collections import Counter
+from datetime import date, time
+from typing import Dict, List, Tuple
+
+from django.db import transaction
 from django.utils import timezone
 
+from mensautils.canteen import instrumentation
+from mensautils.canteen.caching import bump_canteen_version, bump_data_version
 from mensautils.canteen.models import Canteen, Dish, OpeningTime, Serving
+from mensautils.canteen.notifications import queue_notifications
+from mensautils.canteen.statistics import count_servings
+from mensautils.parser import canteen_result
 from mensautils.parser.canteen_result import CanteenResult
 
 
 def store_canteen_data(canteen_name: str, result: CanteenResult):
-    """Save/update the canteen data and a CanteenResult returned by parser."""
-    canteen, _ = Canteen.objects.get_or_create(name=canteen_name)
-
-    # store opening times
-    for weekday, opening in result.opening_times.items():
-        opening_object = OpeningTime.objects.filter(
-            canteen=canteen, weekday=weekday)
-        if opening_object.count() < 1:
-            OpeningTime.objects.create(
-                canteen=canteen, weekday=weekday,
-                start=opening[0], end=opening[1])
-        else:
-            opening_object = opening_object.first()
-            opening_object.start = opening[0]
-            opening_object.end = opening[1]
-            opening_object.save()
+    """Save/update the canteen data and a CanteenResult returned by parser.
+
+    Only rows which actually changed are written, using a constant number of
+    queries unless new dishes are encountered.
+    """
+    with transaction.atomic():
+        canteen, _ = Canteen.objects.get_or_create(name=canteen_name)
+        opening_times_changed = _store_opening_times(canteen, result.opening_times)
+        servings_changed = _store_servings(canteen, result.servings)
+        # bulk writes do not send the signals invalidating caches
+        if opening_times_changed:
+            bump_canteen_version()
+        if opening_times_changed or servings_changed:
+            bump_data_version()
+
+
+def _store_opening_times(canteen: Canteen,
+                         opening_times: Dict[int, Tuple[time, time]]) -> bool:
+    """Store the opening times of a canteen and return whether any changed."""
+    existing = {opening.weekday: opening
+                for opening in OpeningTime.objects.filter(canteen=canteen)}
+    created = []
+    changed = []
+    for weekday, (start, end) in opening_times.items():
+        opening = existing.get(weekday)
+        if opening is None:
+            created.append(OpeningTime(
+                canteen=canteen, weekday=weekday, start=start, end=end))
+        elif (opening.start, opening.end) != (start, end):
+            opening.start = start
+            opening.end = end
+            changed.append(opening)
+
+    OpeningTime.objects.bulk_create(created)
+    OpeningTime.objects.bulk_update(changed, ['start', 'end'])
+    return bool(created or changed)
+
+
+def backfill_servings(servings: Dict[str, List[canteen_result.Serving]]) -> int:
+    """Store historical servings of many canteens and get the number of
+    created ones.
+
+    Unlike store_canteen_data(), stored servings are left untouched, none
+    are marked as deprecated and no notifications are sent. New dishes are
+    created in the order of the servings, which should be sorted by date.
+    """
+    listed = [(canteen_name, serving)
+              for canteen_name, canteen_servings in servings.items()
+              for serving in canteen_servings]
+    if not listed:
+        return 0
+
+    with transaction.atomic():
+        canteens = {canteen.name: canteen for canteen in Canteen.objects.filter(
+            name__in=servings)}
+        for canteen_name in servings:
+            if canteen_name not in canteens:
+                canteens[canteen_name] = Canteen.objects.create(name=canteen_name)
+
+        listed.sort(key=lambda item: item[1].day)
+        dish_pks = Dish.fuzzy_find_or_create_pks([
+            (serving.title, serving.vegetarian, serving.vegan)
+            for _, serving in listed])
+        days = [serving.day for _, serving in listed]
+        existing = set(Serving.objects.filter(
+            canteen__in=canteens.values(), date__range=(min(days), max(days))
+        ).values_list('canteen_id', 'date', 'dish_id'))
+
+        now = timezone.now()
+        created = {}  # type: Dict[Tuple[int, date, int], Serving]
+        for (canteen_name, serving), dish_pk in zip(listed, dish_pks):
+            key = canteens[canteen_name].pk, serving.day, dish_pk
+            if key in existing:
+                continue
+            # dish listed twice, the last listing wins
+            created[key] = Serving(
+                date=serving.day, canteen_id=key[0], dish_id=dish_pk,
+                price=serving.price, price_staff=serving.price_staff,
+                last_updated=now, notified=True)
+
+        Serving.objects.bulk_create(created.values(), batch_size=500)
+        # bulk_create does not send the signal updating the statistics
+        count_servings(Counter(dish_pk for _, _, dish_pk in created))
+        if created:
+            bump_data_version()
+    return len(created)
+
+
+def _get_created_pks(canteen: Canteen, created: Dict[Tuple[date, int], Serving]) -> List[int]:
+    """Get the primary keys of bulk created servings.
+
+    Only some databases return them from bulk_create, otherwise they are
+    queried. No other serving has the same day and dish as a created one.
+    """
+    if all(serving.pk is not None for serving in created.values()):
+        return [serving.pk for serving in created.values()]
+    return [pk for pk, day, dish_pk in Serving.objects.filter(
+                canteen=canteen, date__in={day for day, _ in created}).values_list(
+                'pk', 'date', 'dish_id')
+            if (day, dish_pk) in created]
+
+
+def _store_servings(canteen: Canteen, servings: List[canteen_result.Serving]) -> bool:
+    """Store the servings of a canteen and return whether any changed."""
+    if not servings:
+        return False
 
     now = timezone.now()
-    days = set()
+    with instrumentation.stage('dish_match', canteen.name):
+        dish_pks = Dish.fuzzy_find_or_create_pks([
+            (serving.title, serving.vegetarian, serving.vegan)
+            for serving in servings])
+    days = {serving.day for serving in servings}
 
-    for serving in result.servings:
-        dish = Dish.fuzzy_find_or_create(
-            name=serving.title, vegetarian=serving.vegetarian,
-            vegan=serving.vegan)
+    existing = {}  # type: Dict[Tuple[date, int], List[Serving]]
+    for serving_object in Serving.objects.filter(canteen=canteen, date__in=days):
+        existing.setdefault(
+            (serving_object.date, serving_object.dish_id), []).append(serving_object)
+
+    created = {}  # type: Dict[Tuple[date, int], Serving]
+    changed = {}  # type: Dict[int, Serving]
+    seen = set()
+    for serving, dish_pk in zip(servings, dish_pks):
+        key = serving.day, dish_pk
+        if key in created:
+            # dish listed twice, the last listing wins
+            created[key].price = serving.price
+            created[key].price_staff = serving.price_staff
+            continue
+        if key not in existing:
+            created[key] = Serving(
+                date=serving.day, canteen=canteen, dish_id=dish_pk,
+                price=serving.price, price_staff=serving.price_staff,
+                last_updated=now)
+            continue
 
         # search for serving (allow different price)
-        possible_servings = Serving.objects.filter(
-            date=serving.day, canteen=canteen, dish=dish)
-        if possible_servings.count() == 0:
-            # create new entry
-            created = True
-            serving_object = Serving.objects.create(
-                date=serving.day, canteen=canteen, dish=dish,
-                price=serving.price, price_staff=serving.price_staff)
-        elif possible_servings.count() == 1:
-            created = False
-            serving_object = possible_servings.first()
+        candidates = existing[key]
+        serving_object = next(
+            (candidate for candidate in candidates
+             if (candidate.price, candidate.price_staff) ==
+             (serving.price, serving.price_staff)),
+            candidates[0])
+        seen.add(serving_object.pk)
+        if (serving_object.price != serving.price or
+                serving_object.price_staff != serving.price_staff or
+                serving_object.officially_deprecated or
+                not serving_object.official):
             serving_object.price = serving.price
             serving_object.price_staff = serving.price_staff
-        else:
-            # multiple servings. filter for price.
-            created = False
-            # TODO: missing handling of this case
-
-        if not created:
-            serving_object.last_updated = now
             serving_object.officially_deprecated = False
             serving_object.official = True
-            serving_object.save()
-        days.add(serving.day)
+            serving_object.last_updated = now
+            changed[serving_object.pk] = serving_object
 
     # mark old dishes for same day and canteen as deprecated
-    Serving.objects.filter(
-        date__in=days, canteen=canteen, last_updated__lt=now, official=True
-    ).update(officially_deprecated=True)
+    for serving_objects in existing.values():
+        for serving_object in serving_objects:
+            if (serving_object.official and
+                    not serving_object.officially_deprecated and
+                    serving_object.pk not in seen):
+                serving_object.officially_deprecated = True
+                changed[serving_object.pk] = serving_object
+
+    Serving.objects.bulk_create(created.values())
+    # bulk_create does not send the signal updating the statistics
+    count_servings(Counter(dish_pk for _, dish_pk in created))
+    if created:
+        queue_notifications(_get_created_pks(canteen, created))
+    Serving.objects.bulk_update(changed.values(), [
+        'price', 'price_staff', 'last_updated', 'officially_deprecated',
+        'official'])
+    return bool(created or changed)
@@ -0,0 +1,114 @@
+"""Import of historical plans from saved pages.
+
+The pages are stored in the layout described in snapshots, with the
+Studierendenwerk day plans in the stwhh and the DESY week plans in the desy
+subdirectory of a snapshot directory.
+
+The pages are parsed in a process pool and the servings are stored in date
+order, a batch of days at a time. If several pages list the same canteen
+and day, the servings of the last one are used.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Dict, Iterator, List, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+from mensautils.canteen.archive import backfill_servings
+from mensautils.canteen.snapshots import DESY, STWHH
+from mensautils.parser import desy, studierendenwerk
+from mensautils.parser.canteen_result import Serving
+
+
+class Throughput:
+    def __init__(self, unit: str):
+        self.unit = unit
+        self.count = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return '{} {} in {:.1f} s ({:.1f} {}/s)'.format(
+            self.count, self.unit, self.seconds,
+            self.count / self.seconds if self.seconds else 0, self.unit)
+
+
+def get_snapshot_sources() -> Dict[str, List[Tuple[str, Dict]]]:
+    """Get the configured canteens of every source of the snapshots."""
+    sources = {STWHH: [], DESY: []}
+    for canteen_name, canteen_callable, kwargs in settings.CANTEENS:
+        if canteen_callable is studierendenwerk.get_canteen_data:
+            sources[STWHH].append((canteen_name, kwargs))
+        elif canteen_callable is desy.get_canteen_data:
+            sources[DESY].append((canteen_name, kwargs))
+    return sources
+
+
+def parse_snapshot(source: str, path: str,
+                   canteens: List[Tuple[str, Dict]]) -> Dict[str, List[Serving]]:
+    """Parse the servings of the configured canteens from a saved page.
+
+    This is run in the worker processes, so it does not use the database.
+    """
+    with open(path, encoding='utf-8') as f:
+        page = f.read()
+    if source == STWHH:
+        names = {kwargs['canteen_number']: canteen_name
+                 for canteen_name, kwargs in canteens}
+        return {names[number]: servings for number, servings in
+                studierendenwerk.parse_day_plan(page, list(names)).items()}
+    return {canteen_name: desy.parse_plan(
+                page, english=kwargs.get('english', False)).servings
+            for canteen_name, kwargs in canteens}
+
+
+def parse_snapshots(snapshots: List[Tuple[str, str]], workers: int,
+                    throughput: Throughput) -> Dict[Tuple[str, date], List[Serving]]:
+    """Parse all snapshots and get the servings of every canteen and day."""
+    sources = get_snapshot_sources()
+    # forked workers must not share the connections of this process
+    connections.close_all()
+
+    servings = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # the results are returned in the order of the snapshots
+        results = executor.map(
+            parse_snapshot, [source for source, _ in snapshots],
+            [path for _, path in snapshots],
+            [sources[source] for source, _ in snapshots], chunksize=4)
+        for canteen_servings in results:
+            throughput.count += 1
+            for canteen_name, listed in canteen_servings.items():
+                days = {}
+                for serving in listed:
+                    days.setdefault(serving.day, []).append(serving)
+                for day, day_servings in days.items():
+                    servings[(canteen_name, day)] = day_servings
+    throughput.seconds = time.perf_counter() - start
+    return servings
+
+
+def store_snapshots(servings: Dict[Tuple[str, date], List[Serving]], batch_days: int,
+                    throughput: Throughput) -> Iterator[Tuple[date, date, int]]:
+    """Store the servings in date order and yield the days and the number
+    of created servings of every batch.
+    """
+    by_day = {}  # type: Dict[date, List[Tuple[str, List[Serving]]]]
+    for (canteen_name, day), day_servings in servings.items():
+        by_day.setdefault(day, []).append((canteen_name, day_servings))
+
+    days = sorted(by_day)
+    for index in range(0, len(days), batch_days):
+        batch = days[index:index + batch_days]
+        batch_servings = {}  # type: Dict[str, List[Serving]]
+        for day in batch:
+            for canteen_name, day_servings in by_day[day]:
+                batch_servings.setdefault(canteen_name, []).extend(day_servings)
+
+        start = time.perf_counter()
+        created = backfill_servings(batch_servings)
+        throughput.seconds += time.perf_counter() - start
+        throughput.count += sum(len(listed) for listed in batch_servings.values())
+        yield batch[0], batch[-1], created
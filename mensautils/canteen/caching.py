@@ -0,0 +1,53 @@
+"""Caching of data derived from the canteen data.
+
+Cache keys contain a data version, which is replaced whenever the data
+shown to users changes. Outdated entries are never read again and expire
+on their own.
+
+The canteens and their opening times change far less often than the
+servings, so data derived only from them uses a separate canteen version.
+"""
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+DATA_VERSION_KEY = 'mensautils:data-version'
+CANTEEN_VERSION_KEY = 'mensautils:canteen-version'
+
+
+def get_data_version() -> str:
+    return _get_version(DATA_VERSION_KEY)
+
+
+def bump_data_version():
+    """Invalidate everything cached for the current data.
+
+    Inside a transaction, the version is only replaced after the commit, so
+    that the old data cannot be cached for the new version.
+    """
+    transaction.on_commit(lambda: _new_version(DATA_VERSION_KEY))
+
+
+def get_canteen_version() -> str:
+    return _get_version(CANTEEN_VERSION_KEY)
+
+
+def bump_canteen_version():
+    """Invalidate everything cached for the current canteens, like
+    bump_data_version().
+    """
+    transaction.on_commit(lambda: _new_version(CANTEEN_VERSION_KEY))
+
+
+def _get_version(key: str) -> str:
+    version = cache.get(key)
+    if version is None:
+        version = _new_version(key)
+    return version
+
+
+def _new_version(key: str) -> str:
+    version = uuid.uuid4().hex
+    cache.set(key, version, None)
+    return version
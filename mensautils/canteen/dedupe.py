@@ -0,0 +1,147 @@
+"""Merging of near-duplicate dishes.
+
+Dishes are duplicates if they have the same flags and their names reach
+FUZZY_MIN_RATIO with fuzz.token_sort_ratio, just like Dish.fuzzy_find_or_create
+matches them. Every dish is merged into the oldest dish it matches which is
+not merged itself, so it always reaches the threshold with the dish it is
+merged into, and this is the dish the matcher returns for it afterwards.
+Dishes only matching merged dishes are kept.
+
+Servings of the same canteen and day which end up with the same dish are
+deprecated except for the oldest one.
+
+Candidate pairs are found with the q-gram indexes of the matcher and scored
+in a process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Case, IntegerField, Value, When
+from fuzzywuzzy import fuzz
+
+from mensautils.canteen.caching import bump_data_version
+from mensautils.canteen.matching import QGramIndex, token_sort_key
+from mensautils.canteen.models import Dish, Serving
+from mensautils.canteen.statistics import rebuild_dish_statistics
+
+# dishes scored by a worker at a time
+SCORING_CHUNK_SIZE = 500
+
+# duplicates re-pointed by one query
+MERGE_BATCH_SIZE = 500
+
+# state of the worker processes
+_keys = {}  # type: Dict[int, str]
+_indexes = {}  # type: Dict[Tuple[bool, bool], QGramIndex]
+
+
+def _init_worker(dishes: List[Tuple[int, str, Tuple[bool, bool]]]):
+    _keys.clear()
+    _indexes.clear()
+    for pk, key, flags in dishes:
+        _keys[pk] = key
+        _indexes.setdefault(flags, QGramIndex()).add(pk, key)
+
+
+def _score(dishes: List[Tuple[int, str, Tuple[bool, bool]]],
+           min_ratio: int) -> List[Tuple[int, int]]:
+    """Get the pairs of dishes reaching min_ratio with an older dish."""
+    pairs = []
+    for pk, key, flags in dishes:
+        for other_pk in _indexes[flags].candidates(key, min_ratio):
+            if other_pk < pk and fuzz.ratio(key, _keys[other_pk]) >= min_ratio:
+                pairs.append((other_pk, pk))
+    return pairs
+
+
+def find_duplicates(workers: int = 1,
+                    min_ratio: Optional[int] = None) -> Dict[int, List[int]]:
+    """Get the duplicates of every dish which has any, by the dish they
+    are merged into.
+    """
+    if min_ratio is None:
+        min_ratio = settings.FUZZY_MIN_RATIO
+    dishes = [(pk, token_sort_key(name), (bool(vegetarian), bool(vegan)))
+              for pk, name, vegetarian, vegan in Dish.objects.order_by('pk').values_list(
+                  'pk', 'name', 'vegetarian', 'vegan')]
+    chunks = [dishes[start:start + SCORING_CHUNK_SIZE]
+              for start in range(0, len(dishes), SCORING_CHUNK_SIZE)]
+
+    # forked workers must not share the connections of this process
+    connections.close_all()
+    older = {}  # type: Dict[int, List[int]]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(dishes,)) as executor:
+        for pairs in executor.map(_score, chunks, [min_ratio] * len(chunks)):
+            for other_pk, pk in pairs:
+                older.setdefault(pk, []).append(other_pk)
+
+    canonical = {}  # type: Dict[int, int]
+    clusters = {}  # type: Dict[int, List[int]]
+    for pk in sorted(older):
+        # older dishes are decided first
+        kept = [other_pk for other_pk in older[pk] if other_pk not in canonical]
+        if kept:
+            canonical[pk] = min(kept)
+            clusters.setdefault(canonical[pk], []).append(pk)
+    return clusters
+
+
+def merge_duplicates(clusters: Dict[int, List[int]]) -> Tuple[int, int]:
+    """Move the servings of the duplicates to their canonical dish and
+    delete the duplicates. Returns the numbers of moved and deprecated
+    servings.
+    """
+    canonical = {duplicate_pk: dish_pk for dish_pk, duplicate_pks in clusters.items()
+                 for duplicate_pk in duplicate_pks}
+    duplicate_pks = sorted(canonical)
+    moved = 0
+    with transaction.atomic():
+        for start in range(0, len(duplicate_pks), MERGE_BATCH_SIZE):
+            batch = duplicate_pks[start:start + MERGE_BATCH_SIZE]
+            moved += Serving.objects.filter(dish_id__in=batch).update(dish_id=Case(
+                *[When(dish_id=duplicate_pk, then=Value(canonical[duplicate_pk]))
+                  for duplicate_pk in batch],
+                output_field=IntegerField()))
+            Dish.objects.filter(pk__in=batch).delete()
+        deprecated = _deprecate_collisions(sorted(clusters))
+        rebuild_dish_statistics(clusters)
+        # update() does not send the signals invalidating caches
+        bump_data_version()
+    return moved, deprecated
+
+
+def _deprecate_collisions(dish_pks: List[int]) -> int:
+    """Deprecate all servings of the dishes except the oldest one of every
+    canteen and day and return their number.
+    """
+    deprecated = 0
+    for start in range(0, len(dish_pks), MERGE_BATCH_SIZE):
+        batch = dish_pks[start:start + MERGE_BATCH_SIZE]
+        seen = set()
+        collisions = []
+        for pk, canteen_pk, day, dish_pk in Serving.objects.filter(
+                dish_id__in=batch, officially_deprecated=False).order_by('pk').values_list(
+                'pk', 'canteen_id', 'date', 'dish_id'):
+            key = canteen_pk, day, dish_pk
+            if key in seen:
+                collisions.append(pk)
+            else:
+                seen.add(key)
+        for collision_start in range(0, len(collisions), MERGE_BATCH_SIZE):
+            deprecated += Serving.objects.filter(
+                pk__in=collisions[collision_start:collision_start + MERGE_BATCH_SIZE]
+            ).update(officially_deprecated=True)
+    return deprecated
+
+
+def iter_report(clusters: Dict[int, List[int]]) -> Iterable[str]:
+    """Describe the clusters, largest first."""
+    names = dict(Dish.objects.values_list('pk', 'name'))
+    for dish_pk, duplicate_pks in sorted(
+            clusters.items(), key=lambda cluster: (-len(cluster[1]), cluster[0])):
+        yield '{} ({})'.format(names[dish_pk], dish_pk)
+        for duplicate_pk in duplicate_pks:
+            yield '  <- {} ({})'.format(names[duplicate_pk], duplicate_pk)
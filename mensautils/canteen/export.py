@@ -0,0 +1,180 @@
+"""Streaming export of the serving and rating history.
+
+The rows are read with a server-side cursor in chunks and written one at a
+time, so exports of any size need a constant amount of memory. Ratings are
+exported without their users.
+"""
+import csv
+import json
+import zlib
+from datetime import date
+from decimal import Decimal
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from django.db.models import QuerySet
+from django.utils.dateparse import parse_date
+
+from mensautils.canteen.models import Rating, Serving
+
+# rows read from the database at a time
+CHUNK_SIZE = 2000
+
+# bytes collected before they are compressed or sent
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+# exported columns of every kind and the fields they are read from
+KINDS = {
+    'servings': [
+        ('id', 'pk'), ('date', 'date'), ('canteen_id', 'canteen_id'),
+        ('canteen', 'canteen__name'), ('dish_id', 'dish_id'), ('dish', 'dish__name'),
+        ('vegetarian', 'dish__vegetarian'), ('vegan', 'dish__vegan'),
+        ('price', 'price'), ('price_staff', 'price_staff'),
+        ('official', 'official'), ('officially_deprecated', 'officially_deprecated'),
+        ('rating_sum', 'rating_sum'), ('rating_count', 'rating_count'),
+    ],
+    'ratings': [
+        ('serving_id', 'serving_id'), ('date', 'serving__date'),
+        ('canteen_id', 'serving__canteen_id'), ('canteen', 'serving__canteen__name'),
+        ('dish_id', 'serving__dish_id'), ('dish', 'serving__dish__name'),
+        ('rating', 'rating'),
+    ],
+}
+
+
+class ExportFilters(NamedTuple):
+    start: Optional[date] = None
+    end: Optional[date] = None
+    canteen_pks: Sequence[int] = ()
+
+
+def parse_filters(start: Optional[str], end: Optional[str],
+                  canteens: Sequence[str]) -> ExportFilters:
+    """Parse the filters given as strings.
+
+    Raises ValueError if a filter is invalid.
+    """
+    days = []
+    for value in (start, end):
+        day = None
+        if value:
+            try:
+                day = parse_date(value)
+            except ValueError:
+                pass
+            if day is None:
+                raise ValueError('Dates have to be given as YYYY-MM-DD.')
+        days.append(day)
+    try:
+        canteen_pks = [int(canteen) for canteen in canteens]
+    except ValueError:
+        raise ValueError('Canteen ids have to be numbers.')
+    return ExportFilters(days[0], days[1], canteen_pks)
+
+
+def parse_flag(value: Optional[str]) -> bool:
+    """Parse a flag given as a string, which is false if it is missing.
+
+    Raises ValueError if the value is invalid.
+    """
+    if value is None:
+        return False
+    value = value.lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('', '0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('Flags have to be given as 1 or 0.')
+
+
+def get_rows(kind: str, filters: ExportFilters) -> Tuple[List[str], QuerySet]:
+    """Get the column names and the rows of an export."""
+    columns = KINDS[kind]
+    if kind == 'servings':
+        rows = Serving.objects.order_by('date', 'canteen_id', 'id')
+        prefix = ''
+    else:
+        rows = Rating.objects.order_by('serving__date', 'serving_id', 'id')
+        prefix = 'serving__'
+
+    if filters.start is not None:
+        rows = rows.filter(**{prefix + 'date__gte': filters.start})
+    if filters.end is not None:
+        rows = rows.filter(**{prefix + 'date__lte': filters.end})
+    if filters.canteen_pks:
+        rows = rows.filter(**{prefix + 'canteen_id__in': filters.canteen_pks})
+    return ([name for name, _ in columns],
+            rows.values_list(*[field for _, field in columns]))
+
+
+class _Line:
+    """File-like object returning what is written, used by csv.writer."""
+    def write(self, value: str) -> str:
+        return value
+
+
+def _to_json(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def iter_export(kind: str, export_format: str, filters: ExportFilters,
+                compress: bool = False) -> Iterator[bytes]:
+    """Iterate over the encoded lines of an export."""
+    columns, rows = get_rows(kind, filters)
+    rows = rows.iterator(chunk_size=CHUNK_SIZE)
+    if export_format == 'csv':
+        writer = csv.writer(_Line())
+        lines = (writer.writerow(row) for row in _with_header(columns, rows))
+    else:
+        lines = (json.dumps(dict(zip(columns, map(_to_json, row))),
+                            ensure_ascii=False) + '\n'
+                 for row in rows)
+    chunks = _buffer(line.encode('utf-8') for line in lines)
+    if compress:
+        return _compress(chunks)
+    return chunks
+
+
+def _with_header(columns: List[str], rows: Iterable[Tuple]) -> Iterator[Sequence]:
+    yield columns
+    yield from rows
+
+
+def _buffer(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """Join lines into chunks of about BUFFER_SIZE bytes."""
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _compress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compress chunks into the gzip format."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def get_file_name(kind: str, export_format: str, compress: bool) -> str:
+    file_name = '{}.{}'.format(kind, FORMATS[export_format][1])
+    if compress:
+        file_name += '.gz'
+    return file_name
@@ -0,0 +1,177 @@
+"""Fetch the data of all configured canteens and archive it."""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from mensautils.canteen import instrumentation
+from mensautils.canteen.archive import store_canteen_data
+from mensautils.canteen.models import FetchState
+from mensautils.parser import http, studierendenwerk
+from mensautils.parser.canteen_result import CanteenResult
+
+# parsers which can fetch several canteens at once, mapped to their batch
+# variant and the keyword argument selecting the canteen
+BATCH_PARSERS = {
+    studierendenwerk.get_canteen_data: (
+        studierendenwerk.get_canteens_data, 'canteen_number'),
+}
+
+
+class FetchJob:
+    """Fetch one canteen or a batch of canteens sharing the same source."""
+    def __init__(self, canteen_callable: Callable, kwargs: Dict,
+                 canteens: List[Tuple[str, Optional[int]]],
+                 number_kwarg: Optional[str] = None):
+        self.canteen_callable = canteen_callable
+        self.kwargs = kwargs
+        self.canteens = canteens
+        self.number_kwarg = number_kwarg
+
+    def __str__(self):
+        return ', '.join(canteen_name for canteen_name, _ in self.canteens)
+
+    @property
+    def label(self) -> str:
+        """Get a short name of the job, which is the module of the parser
+        for batches.
+        """
+        if self.number_kwarg is None:
+            return str(self)
+        return self.canteen_callable.__module__.rsplit('.', 1)[-1]
+
+    def run(self, cache: Optional[http.FetchCache] = None) -> List[Tuple[str, CanteenResult]]:
+        """Fetch and parse the data of all canteens of this job.
+
+        Nothing is returned if the source did not change since the
+        validators in the cache were stored. If fetching or parsing fails,
+        the validators of this job are not updated.
+        """
+        kwargs = dict(self.kwargs)
+        if cache is not None:
+            kwargs['cache'] = cache.copy()
+
+        try:
+            with instrumentation.fetch_stages(self.label):
+                if self.number_kwarg is None:
+                    canteen_name, _ = self.canteens[0]
+                    results = {None: self.canteen_callable(**kwargs)}
+                else:
+                    results = self.canteen_callable(
+                        [number for _, number in self.canteens], **kwargs)
+        except http.NotModified:
+            results = {}
+
+        if cache is not None:
+            cache.merge(kwargs['cache'])
+        if not results:
+            return []
+        return [(canteen_name, results[number])
+                for canteen_name, number in self.canteens]
+
+
+def build_jobs(canteens: List[Tuple[str, Callable, Dict]]) -> List[FetchJob]:
+    """Build the fetch jobs for canteens as configured in settings.CANTEENS."""
+    jobs = []
+    batches = {}
+    for canteen_name, canteen_callable, canteen_kwargs in canteens:
+        if canteen_callable not in BATCH_PARSERS:
+            jobs.append(FetchJob(
+                canteen_callable, canteen_kwargs, [(canteen_name, None)]))
+            continue
+
+        # canteens sharing the same source are fetched together
+        batch_callable, number_kwarg = BATCH_PARSERS[canteen_callable]
+        kwargs = dict(canteen_kwargs)
+        number = kwargs.pop(number_kwarg)
+        batch_key = batch_callable, tuple(sorted(kwargs.items()))
+        if batch_key not in batches:
+            batches[batch_key] = FetchJob(
+                batch_callable, kwargs, [], number_kwarg=number_kwarg)
+            jobs.append(batches[batch_key])
+        batches[batch_key].canteens.append((canteen_name, number))
+    return jobs
+
+
+def run_jobs(jobs: List[FetchJob], workers: int = 1,
+             cache: Optional[http.FetchCache] = None,
+             on_error: Optional[Callable[[FetchJob, Exception], None]] = None) -> Iterator[
+        Tuple[FetchJob, List[Tuple[str, CanteenResult]]]]:
+    """Run fetch jobs, yielding their results as soon as they are available.
+
+    With more than one worker, the jobs are run in a thread pool. The
+    results are still yielded in the calling thread, so that all database
+    writes happen in a single thread.
+
+    If on_error is given, jobs raising an exception are passed to it
+    instead of stopping the other jobs.
+    """
+    if workers <= 1:
+        for job in jobs:
+            try:
+                results = job.run(cache)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(job, e)
+                continue
+            yield job, results
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(job.run, cache): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(futures[future], e)
+                continue
+            yield futures[future], results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_fetch_cache() -> http.FetchCache:
+    """Load the validators stored by previous runs."""
+    return http.FetchCache({
+        state.url: (state.etag, state.last_modified, state.content_hash)
+        for state in FetchState.objects.all()})
+
+
+def save_fetch_cache(cache: http.FetchCache):
+    """Store the validators of all pages fetched in this run."""
+    now = timezone.now()
+    for url, (etag, last_modified, content_hash) in cache.updated.items():
+        FetchState.objects.update_or_create(url=url, defaults={
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_hash': content_hash,
+            'last_fetched': now,
+        })
+    cache.updated.clear()
+
+
+def fetch_canteens(workers: int = 1, force: bool = False):
+    """Fetch the data of all configured canteens and store it.
+
+    Sources which did not change since the last run are skipped unless
+    force is set.
+    """
+    fetch_jobs(build_jobs(settings.CANTEENS), workers, force)
+
+
+def fetch_jobs(jobs: List[FetchJob], workers: int = 1, force: bool = False,
+               on_error: Optional[Callable[[FetchJob, Exception], None]] = None):
+    """Run fetch jobs and store their results, see fetch_canteens()."""
+    cache = http.FetchCache() if force else load_fetch_cache()
+    for job, results in run_jobs(jobs, workers, cache, on_error):
+        for canteen_name, canteen_result in results:
+            with instrumentation.stage('store', canteen_name):
+                store_canteen_data(canteen_name, canteen_result)
+
+    # only remember the pages once their data has been stored
+    save_fetch_cache(cache)
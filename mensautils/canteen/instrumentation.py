@@ -0,0 +1,215 @@
+"""Metrics of the stages of a fetch run.
+
+Stages are measured only while recording() is active, otherwise they do
+nothing. Every measured stage is logged and all of them can be written to
+a file read by the textfile collector of the Prometheus node exporter.
+
+The stages are fetch and parse per source, store and dish_match per
+canteen and notify. The store stage includes the dish_match stage of the
+same canteen.
+"""
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.db import connection
+
+from mensautils.parser import http
+
+logger = logging.getLogger(__name__)
+
+# name of the metrics and the attribute of StageMetrics they are read from
+PROMETHEUS_METRICS = [
+    ('mensautils_fetch_stage_seconds', 'seconds',
+     'Wall time spent in the stage in seconds.'),
+    ('mensautils_fetch_stage_downloaded_bytes', 'bytes',
+     'Bytes downloaded in the stage.'),
+    ('mensautils_fetch_stage_queries', 'queries',
+     'Database queries run in the stage.'),
+    ('mensautils_fetch_stage_peak_memory_bytes', 'peak_memory',
+     'Peak of the memory traced by tracemalloc during the stage.'),
+]
+
+
+class StageMetrics:
+    def __init__(self, stage: str, label: str):
+        self.stage = stage
+        self.label = label
+        self.seconds = 0.0
+        self.bytes = 0
+        self.queries = 0
+        self.peak_memory = None  # type: Optional[int]
+
+    def __str__(self):
+        fields = ['stage={}'.format(self.stage), 'canteen="{}"'.format(self.label),
+                  'seconds={:.3f}'.format(self.seconds), 'bytes={}'.format(self.bytes),
+                  'queries={}'.format(self.queries)]
+        if self.peak_memory is not None:
+            fields.append('peak_memory={}'.format(self.peak_memory))
+        return ' '.join(fields)
+
+
+class Recorder:
+    """Collect the metrics of all stages measured in any thread."""
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.metrics = []  # type: List[StageMetrics]
+        self._lock = threading.Lock()
+        # stages waiting for their memory peak
+        self._open_stages = []  # type: List[StageMetrics]
+
+    def add(self, metrics: StageMetrics):
+        with self._lock:
+            self.metrics.append(metrics)
+        logger.info('%s', metrics, extra={'metrics': vars(metrics)})
+
+    def open_stage(self, metrics: StageMetrics):
+        if not self.trace_memory:
+            return
+        with self._lock:
+            # the peak is reset for the new stage, so pass it on to the
+            # stages which are still running
+            self._update_peaks()
+            tracemalloc.reset_peak()
+            self._open_stages.append(metrics)
+
+    def close_stage(self, metrics: StageMetrics):
+        if not self.trace_memory:
+            return
+        with self._lock:
+            self._update_peaks()
+            self._open_stages.remove(metrics)
+
+    def _update_peaks(self):
+        _, peak = tracemalloc.get_traced_memory()
+        for metrics in self._open_stages:
+            metrics.peak_memory = max(metrics.peak_memory or 0, peak)
+
+    def aggregate(self) -> Dict[Tuple[str, str], StageMetrics]:
+        """Sum the metrics of each stage and label, keeping the highest peak."""
+        totals = OrderedDict()
+        with self._lock:
+            for metrics in self.metrics:
+                key = metrics.stage, metrics.label
+                if key not in totals:
+                    totals[key] = StageMetrics(*key)
+                total = totals[key]
+                total.seconds += metrics.seconds
+                total.bytes += metrics.bytes
+                total.queries += metrics.queries
+                if metrics.peak_memory is not None:
+                    total.peak_memory = max(total.peak_memory or 0, metrics.peak_memory)
+        return totals
+
+    def write_textfile(self, path: str):
+        """Write the metrics in the Prometheus text format.
+
+        The file is replaced atomically, so the collector never reads a
+        partially written file.
+        """
+        totals = self.aggregate()
+        lines = []
+        for name, attribute, help_text in PROMETHEUS_METRICS:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for (stage, label), metrics in totals.items():
+                value = getattr(metrics, attribute)
+                if value is not None:
+                    lines.append('{}{{stage="{}",canteen="{}"}} {}'.format(
+                        name, _escape(stage), _escape(label), value))
+        lines.append('# HELP mensautils_fetch_last_run_timestamp_seconds '
+                     'Time the last fetch run finished.')
+        lines.append('# TYPE mensautils_fetch_last_run_timestamp_seconds gauge')
+        lines.append('mensautils_fetch_last_run_timestamp_seconds {}'.format(time.time()))
+
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, path)
+
+
+def _escape(label_value: str) -> str:
+    return label_value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+_recorder = None  # type: Optional[Recorder]
+
+
+@contextmanager
+def recording(trace_memory: bool = False) -> Iterator[Recorder]:
+    """Measure all stages run within the block."""
+    global _recorder
+    if trace_memory:
+        tracemalloc.start()
+    _recorder = Recorder(trace_memory)
+    try:
+        yield _recorder
+    finally:
+        _recorder = None
+        if trace_memory:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name: str, label: str = '') -> Iterator[None]:
+    """Measure the time, the downloads and the queries of the block.
+
+    Only the queries of the database connection of the current thread are
+    counted.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+
+    metrics = StageMetrics(name, label)
+
+    def count_query(execute, sql, params, many, context):
+        metrics.queries += 1
+        return execute(sql, params, many, context)
+
+    recorder.open_stage(metrics)
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(count_query), \
+                http.record_transfers() as transfers:
+            yield
+    finally:
+        metrics.seconds = time.perf_counter() - start
+        metrics.bytes = transfers.bytes
+        recorder.close_stage(metrics)
+        recorder.add(metrics)
+
+
+@contextmanager
+def fetch_stages(label: str) -> Iterator[None]:
+    """Measure running a parser, which downloads and parses its pages.
+
+    The time spent waiting for the downloads is recorded as the fetch stage
+    and the remaining time as the parse stage.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+
+    parse = StageMetrics('parse', label)
+    recorder.open_stage(parse)
+    start = time.perf_counter()
+    try:
+        with http.record_transfers() as transfers:
+            yield
+    finally:
+        fetch = StageMetrics('fetch', label)
+        fetch.seconds = transfers.seconds
+        fetch.bytes = transfers.bytes
+        recorder.add(fetch)
+
+        parse.seconds = time.perf_counter() - start - transfers.seconds
+        recorder.close_stage(parse)
+        recorder.add(parse)
@@ -0,0 +1,357 @@
+"""Offline benchmarks of the fetch pipeline.
+
+The parsers are run on recorded or generated pages and the archiver and
+the notifications on a seeded test database, so no source is contacted and
+no production data is touched.
+"""
+import html
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+from itertools import product
+from typing import Callable, Dict, Iterator, List
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import connection
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_databases, teardown_databases)
+
+from mensautils.canteen.archive import store_canteen_data
+from mensautils.canteen.models import Canteen, Dish, Notification, Serving
+from mensautils.canteen.notifications import queue_notifications, send_notifications
+from mensautils.canteen.snapshots import DESY, SOURCES, STWHH, find_snapshots
+from mensautils.canteen.statistics import rebuild_dish_statistics
+from mensautils.parser import desy, http, studierendenwerk
+from mensautils.parser.canteen_result import CanteenResult, Serving as ParsedServing
+
+# recorded pages checked in with the baseline.json measured on them
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus')
+
+DISH_WORDS = (
+    ['Currywurst', 'Schnitzel', 'Gemüselasagne', 'Hähnchenbrust', 'Falafel',
+     'Linseneintopf', 'Seelachsfilet', 'Spaghetti', 'Kartoffelpuffer',
+     'Chili sin Carne', 'Königsberger Klopse', 'Tofu'],
+    ['Wiener Art', 'Bolognese', 'mit Kräuterquark', 'in Currysoße',
+     'mit Hummus', 'vom Grill', 'mit Tomatensoße', 'nach Art des Hauses'],
+    ['Pommes', 'Reis', 'Salzkartoffeln', 'Salat', 'Bulgur', 'Gemüse',
+     'Kartoffelpüree'],
+)
+
+OPENINGS = json.dumps({'openings': [{
+    'dayFrom': 'Montag', 'dayTo': 'Freitag',
+    'timeFrom': '11:00 Uhr', 'timeTo': '14:30 Uhr'}]})
+
+
+def generate_dish_names(count: int, rng: random.Random) -> List[str]:
+    """Generate distinct dish names."""
+    names = ['{} {}, {}'.format(*words) for words in product(*DISH_WORDS)]
+    return rng.sample(names, min(count, len(names)))
+
+
+def generate_stwhh_page(day: date, canteen_numbers: List[int], names: List[str],
+                        rng: random.Random, dishes_per_canteen: int = 8) -> str:
+    """Generate a day plan with the structure of the Studierendenwerk pages."""
+    # the pages contain a lot of markup which is not used by the parser
+    filler = ''.join(
+        '<div class="teaser"><a href="/news/{0}/">News {0}</a>'
+        '<p>Lorem ipsum dolor sit amet.</p></div>\n'.format(i) for i in range(200))
+    locations = ''.join(
+        '<div data-location="{}" data-openings="{}">Mensa</div>\n'.format(
+            number, html.escape(OPENINGS)) for number in canteen_numbers)
+    sections = []
+    for number in canteen_numbers:
+        tiles = []
+        for name in rng.sample(names, min(dishes_per_canteen, len(names))):
+            price = Decimal(rng.randrange(150, 600)) / 100
+            tiles.append(
+                '<div class="menue-tile" data-allergens="{}" data-symbols="{}">'
+                '<h5 class="singlemeal__headline">{}</h5>'
+                '<span class="singlemeal__info">Studierende {} €</span>'
+                '<span class="singlemeal__info">Bedienstete {} €</span>'
+                '</div>\n'.format(
+                    ' '.join(rng.sample('abcdefgh', 2)),
+                    rng.choice(['31', '31 38', '1']), html.escape(name),
+                    str(price).replace('.', ','),
+                    str(price + Decimal('1.60')).replace('.', ',')))
+        sections.append(
+            '<section data-location-id="{}">'
+            '<div class="tx-epwerkmenu-menu-timestamp-active" data-timestamp="{}"></div>\n'
+            '{}</section>\n'.format(number, day.isoformat(), ''.join(tiles)))
+    return '<html><body>{0}{1}{2}{0}</body></html>'.format(
+        filler, locations, ''.join(sections))
+
+
+def generate_desy_page(monday: date, names: List[str], rng: random.Random,
+                       dishes_per_day: int = 5) -> str:
+    """Generate a week plan with the structure of the DESY pages."""
+    entries = []
+    for weekday in range(5):
+        day = monday + timedelta(days=weekday)
+        tables = []
+        for name in rng.sample(names, min(dishes_per_day, len(names))):
+            tables.append(
+                '<table class="entry"><tr><td>{0}<br/>{0}</td>'
+                '<td>€ {1} <img class="category-icons" src="/img/icon-{2}.png"/></td></tr>'
+                '<tr><td><p>Allergene: 1) 3) 13.1)</p></td></tr></table>\n'.format(
+                    html.escape(name), rng.randrange(2, 8) + 0.5,
+                    rng.choice(['meat', 'vegetarian', 'vegan'])))
+        entries.append('<div class="entry" id="entry-{}">{}</div>\n'.format(
+            day.isoformat(), ''.join(tables)))
+    return ('<html><body><div id="openings"><p>Kantine<br/>Mo - Fr, 11.00 - 14.00'
+            '</p></div>{}</body></html>'.format(''.join(entries)))
+
+
+def stwhh_canteen_numbers() -> List[int]:
+    """Get the numbers of the configured Studierendenwerk canteens."""
+    return [kwargs['canteen_number'] for _, canteen_callable, kwargs in settings.CANTEENS
+            if canteen_callable is studierendenwerk.get_canteen_data]
+
+
+def generate_corpus(seed: int = 0, days: int = 2) -> Dict[str, List[str]]:
+    """Generate Studierendenwerk pages for some days and a DESY week plan."""
+    rng = random.Random(seed)
+    names = generate_dish_names(200, rng)
+    today = date.today()
+    canteen_numbers = stwhh_canteen_numbers()
+    return {
+        STWHH: [generate_stwhh_page(today + timedelta(days=day), canteen_numbers,
+                                    names, rng)
+                for day in range(days)],
+        DESY: [generate_desy_page(today - timedelta(days=today.weekday()), names, rng)],
+    }
+
+
+def load_corpus(directory: str) -> Dict[str, List[str]]:
+    """Load the recorded pages from the source subdirectories of directory."""
+    corpus = {source: [] for source in SOURCES}
+    for source, path in find_snapshots(directory):
+        with open(path, encoding='utf-8') as f:
+            corpus[source].append(f.read())
+    return corpus
+
+
+def record_corpus(directory: str) -> List[str]:
+    """Download the current pages of all sources into directory."""
+    prefix = date.today().isoformat()
+    today_url, next_day_url = studierendenwerk.plan_urls()
+    pages = [
+        (STWHH, '{}-today.html'.format(prefix), today_url),
+        (STWHH, '{}-next-day.html'.format(prefix), next_day_url),
+        (DESY, '{}.html'.format(prefix), desy.plan_url()),
+    ]
+
+    paths = []
+    for source, file_name, url in pages:
+        response = http.get(url)
+        response.raise_for_status()
+        if source == DESY:
+            response.encoding = response.apparent_encoding
+        os.makedirs(os.path.join(directory, source), exist_ok=True)
+        path = os.path.join(directory, source, file_name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(response.text)
+        paths.append(path)
+    return paths
+
+
+@contextmanager
+def benchmark_environment():
+    """Run the benchmarks on test databases, a local cache and local mail."""
+    with override_settings(
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        mail.outbox = []
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            yield
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            del mail.outbox
+
+
+def seed_database(canteen_names: List[str], rng: random.Random, days: int = 365,
+                  dishes: int = 500, users: int = 50):
+    """Fill the database with a history of servings and notifications."""
+    today = date.today()
+    canteen_objs = [Canteen.objects.create(name=name) for name in canteen_names]
+    Dish.objects.bulk_create([
+        Dish(name=name, vegetarian=False, vegan=False)
+        for name in generate_dish_names(dishes, rng)])
+    dish_pks = list(Dish.objects.values_list('pk', flat=True))
+
+    servings = []
+    for day in range(-days, 1):
+        for canteen in canteen_objs:
+            for dish_pk in rng.sample(dish_pks, min(8, len(dish_pks))):
+                servings.append(Serving(
+                    date=today + timedelta(days=day), canteen=canteen,
+                    dish_id=dish_pk, price=Decimal('2.50'),
+                    price_staff=Decimal('4.10'), notified=day < 0))
+    Serving.objects.bulk_create(servings, batch_size=1000)
+    rebuild_dish_statistics()
+
+    for i in range(users):
+        user = User.objects.create_user(
+            'benchmark{}'.format(i), 'benchmark{}@example.com'.format(i))
+        for words in rng.sample(DISH_WORDS, 2):
+            Notification.objects.create(user=user, pattern=rng.choice(words))
+
+
+def measure(prepare: Callable[[int], Callable[[], object]],
+            repeat: int) -> Dict[str, float]:
+    """Measure a stage.
+
+    prepare is called with the number of the run and returns the function
+    to measure, so that setting up a run is not measured. The time is the
+    median of all runs. The memory peak and the queries are taken from an
+    additional run, as tracing the allocations slows down the code.
+    """
+    times = []
+    for run in range(repeat):
+        func = prepare(run)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    func = prepare(repeat)
+    with CaptureQueriesContext(connection) as queries:
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'time': statistics.median(times), 'memory': peak,
+            'queries': len(queries)}
+
+
+def _shift(results: Dict[str, CanteenResult],
+           offset: timedelta) -> Dict[str, CanteenResult]:
+    """Move the servings of parsed results to other days."""
+    return {
+        canteen_name: CanteenResult(result.opening_times, [
+            ParsedServing(serving.day + offset, serving.title, serving.price,
+                          serving.price_staff, serving.vegetarian, serving.vegan,
+                          serving.allergens)
+            for serving in result.servings])
+        for canteen_name, result in results.items()}
+
+
+def parse_corpus(corpus: Dict[str, List[str]]) -> Dict[str, CanteenResult]:
+    """Parse all pages of the corpus like a fetch of all canteens would."""
+    canteen_numbers = stwhh_canteen_numbers()
+    results = {}
+    if corpus[STWHH]:
+        # the opening times are taken from the page of the first day
+        opening_times = studierendenwerk.parse_opening_times(
+            corpus[STWHH][0], canteen_numbers)
+        servings = {number: [] for number in canteen_numbers}
+        for page in corpus[STWHH]:
+            for number, day_servings in studierendenwerk.parse_day_plan(
+                    page, canteen_numbers).items():
+                servings[number] += day_servings
+        for number in canteen_numbers:
+            results['Benchmark {}'.format(number)] = CanteenResult(
+                opening_times[number], servings[number])
+    for i, page in enumerate(corpus[DESY]):
+        results['Benchmark DESY {}'.format(i)] = desy.parse_plan(page)
+    return results
+
+
+def run_benchmarks(corpus: Dict[str, List[str]], repeat: int = 5,
+                   seed: int = 0, days: int = 365) -> Dict[str, Dict[str, float]]:
+    """Seed the database with days of history and benchmark all stages of
+    the pipeline.
+
+    Has to be run within benchmark_environment().
+    """
+    canteen_numbers = stwhh_canteen_numbers()
+    parsed = parse_corpus(corpus)
+    seed_database(list(parsed), random.Random(seed), days=days)
+
+    results = {}
+    results['parse_day_plan'] = measure(lambda run: lambda: [
+        studierendenwerk.parse_day_plan(page, canteen_numbers)
+        for page in corpus[STWHH]], repeat)
+    results['parse_opening_times'] = measure(lambda run: lambda: [
+        studierendenwerk.parse_opening_times(page, canteen_numbers)
+        for page in corpus[STWHH]], repeat)
+    results['parse_full_plan'] = measure(lambda run: lambda: [
+        desy.parse_plan(page) for page in corpus[DESY]], repeat)
+
+    def store(results_to_store: Dict[str, CanteenResult]) -> Callable[[], None]:
+        def run():
+            for canteen_name, result in results_to_store.items():
+                store_canteen_data(canteen_name, result)
+        return run
+
+    # every run stores the plans of days which are not in the database yet,
+    # like the first fetch on a new day
+    days = {serving.day.toordinal()
+            for result in parsed.values() for serving in result.servings}
+    span = timedelta(days=max(days) - min(days) + 1 if days else 1)
+    results['store_canteen_data'] = measure(
+        lambda run: store(_shift(parsed, span * (run + 1))), repeat)
+    # a fetch which did not find any changes
+    unchanged = _shift(parsed, span * (repeat + 2))
+    store(unchanged)()
+    results['store_canteen_data_unchanged'] = measure(
+        lambda run: store(unchanged), repeat)
+
+    def notify(run: int) -> Callable[[], None]:
+        queue_notifications(Serving.objects.filter(
+            date=date.today()).values_list('pk', flat=True))
+        mail.outbox = []
+        return send_notifications
+    results['send_notifications'] = measure(notify, repeat)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """Get the regressions of results compared to a baseline.
+
+    Times and memory peaks may exceed the baseline by the tolerance, query
+    counts must not increase at all.
+    """
+    regressions = []
+    for stage, measurements in results.items():
+        if stage not in baseline:
+            continue
+        for metric in ('time', 'memory'):
+            if measurements[metric] > baseline[stage][metric] * (1 + tolerance):
+                regressions.append('{} {}: {:.4g} > {:.4g}'.format(
+                    stage, metric, measurements[metric], baseline[stage][metric]))
+        if measurements['queries'] > baseline[stage]['queries']:
+            regressions.append('{} queries: {} > {}'.format(
+                stage, measurements['queries'], baseline[stage]['queries']))
+    return regressions
+
+
+def iter_report(results: Dict[str, Dict[str, float]],
+                baseline: Dict[str, Dict[str, float]]) -> Iterator[str]:
+    """Format the results as a table including the change to the baseline."""
+    yield '{:<30} {:>10} {:>8} {:>11} {:>8} {:>8}'.format(
+        'stage', 'time (ms)', 'change', 'memory (kB)', 'change', 'queries')
+    for stage, measurements in results.items():
+        changes = [_format_change(measurements[metric], baseline.get(stage, {}).get(metric))
+                   for metric in ('time', 'memory')]
+        yield '{:<30} {:>10.1f} {:>8} {:>11.0f} {:>8} {:>8}'.format(
+            stage, measurements['time'] * 1000, changes[0],
+            measurements['memory'] / 1000, changes[1], measurements['queries'])
+
+
+def _format_change(value: float, baseline_value) -> str:
+    if not baseline_value:
+        return ''
+    return '{:+.0%}'.format(value / baseline_value - 1)
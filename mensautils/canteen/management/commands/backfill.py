@@ -0,0 +1,37 @@
+import os
+
+from django.core.management import BaseCommand, CommandError
+
+from mensautils.canteen.backfill import Throughput, parse_snapshots, store_snapshots
+from mensautils.canteen.snapshots import find_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Import the servings of saved Studierendenwerk and DESY pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'directory',
+            help='Directory containing the pages in stwhh and desy subdirectories.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of processes parsing the pages.')
+        parser.add_argument(
+            '--batch-days', type=int, default=7,
+            help='Number of days stored in one transaction.')
+
+    def handle(self, *args, **options):
+        snapshots = find_snapshots(options['directory'])
+        if not snapshots:
+            raise CommandError('No pages found in {}.'.format(options['directory']))
+
+        parsing = Throughput('pages')
+        servings = parse_snapshots(snapshots, options['workers'], parsing)
+        self.stdout.write('Parsed {}'.format(parsing))
+
+        storing = Throughput('servings')
+        for first_day, last_day, created in store_snapshots(
+                servings, options['batch_days'], storing):
+            self.stdout.write('Stored {} to {}: {} new servings'.format(
+                first_day, last_day, created))
+        self.stdout.write('Stored {}'.format(storing))
@@ -0,0 +1,75 @@
+import json
+import os
+
+from django.core.management import BaseCommand, CommandError
+
+from mensautils.canteen.management.benchmark import (
+    CORPUS, benchmark_environment, compare, generate_corpus, iter_report,
+    load_corpus, record_corpus, run_benchmarks)
+
+
+class Command(BaseCommand):
+    help = ('Benchmark parsing, archiving and notifying offline and compare '
+            'the results to a baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fixtures',
+            help='Directory with recorded pages in the subdirectories stwhh and '
+                 'desy, like {}. Generated pages are used if it is not '
+                 'given.'.format(CORPUS))
+        parser.add_argument(
+            '--record', action='store_true',
+            help='Download the current pages into the fixtures directory first.')
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Number of measured runs of each stage.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the generated pages and database.')
+        parser.add_argument(
+            '--history-days', type=int, default=365,
+            help='Number of days of servings in the seeded database.')
+        parser.add_argument(
+            '--baseline',
+            help='JSON file with the results to compare to.')
+        parser.add_argument(
+            '--save-baseline', action='store_true',
+            help='Store the results in the baseline file.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.5,
+            help='Allowed relative increase of time and memory.')
+
+    def handle(self, *args, **options):
+        if options['record']:
+            if not options['fixtures']:
+                raise CommandError('--record requires --fixtures.')
+            for path in record_corpus(options['fixtures']):
+                self.stdout.write('Recorded {}'.format(path))
+        if options['save_baseline'] and not options['baseline']:
+            raise CommandError('--save-baseline requires --baseline.')
+
+        if options['fixtures']:
+            corpus = load_corpus(options['fixtures'])
+        else:
+            corpus = generate_corpus(options['seed'])
+
+        with benchmark_environment():
+            results = run_benchmarks(
+                corpus, options['repeat'], options['seed'],
+                options['history_days'])
+
+        baseline = {}
+        if options['baseline'] and os.path.exists(options['baseline']):
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        for line in iter_report(results, baseline):
+            self.stdout.write(line)
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            return
+        regressions = compare(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
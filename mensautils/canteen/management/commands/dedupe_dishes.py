@@ -0,0 +1,37 @@
+import os
+
+from django.core.management import BaseCommand
+
+from mensautils.canteen.dedupe import find_duplicates, iter_report, merge_duplicates
+
+
+class Command(BaseCommand):
+    help = 'Merge dishes whose names are similar enough to be matched.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of processes comparing the dishes.')
+        parser.add_argument(
+            '--min-ratio', type=int,
+            help='Minimum token sort ratio of duplicates, defaults to FUZZY_MIN_RATIO.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the duplicates without merging them.')
+
+    def handle(self, *args, **options):
+        clusters = find_duplicates(options['workers'], options['min_ratio'])
+        if options['verbosity'] > 1 or options['dry_run']:
+            for line in iter_report(clusters):
+                self.stdout.write(line)
+
+        duplicates = sum(len(duplicate_pks) for duplicate_pks in clusters.values())
+        if options['dry_run']:
+            self.stdout.write('{} duplicates of {} dishes found.'.format(
+                duplicates, len(clusters)))
+            return
+        moved, deprecated = merge_duplicates(clusters)
+        self.stdout.write(
+            'Merged {} duplicates into {} dishes, moving {} servings and '
+            'deprecating {} servings listed twice.'.format(
+                duplicates, len(clusters), moved, deprecated))
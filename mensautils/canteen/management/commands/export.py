@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management import BaseCommand, CommandError
+
+from mensautils.canteen import export
+
+
+class Command(BaseCommand):
+    help = 'Export the serving or rating history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(export.KINDS))
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--start', help='First day to export (YYYY-MM-DD).')
+        parser.add_argument('--end', help='Last day to export (YYYY-MM-DD).')
+        parser.add_argument(
+            '--canteen', action='append', default=[],
+            help='Id of a canteen to export, can be given multiple times.')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output.')
+        parser.add_argument(
+            '--output', help='File to write the export to instead of stdout.')
+
+    def handle(self, *args, **options):
+        try:
+            filters = export.parse_filters(
+                options['start'], options['end'], options['canteen'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        chunks = export.iter_export(
+            options['kind'], options['format'], filters, options['gzip'])
+        if options['output'] is None:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        with open(options['output'], 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
@@ -1,19 +1,50 @@
+from contextlib import ExitStack
+
 from django.conf import settings
 from django.core.management import BaseCommand
 
-from mensautils.canteen.archive import store_canteen_data
+from mensautils.canteen import instrumentation
+from mensautils.canteen.fetching import fetch_canteens
 from mensautils.canteen.notifications import send_notifications
 
 
 class Command(BaseCommand):
     help = 'Fetch the canteen data.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            default=getattr(settings, 'FETCH_WORKERS', 1),
+            help='Number of sources to fetch concurrently.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Fetch and store all sources, even if they did not change.')
+        parser.add_argument(
+            '--metrics', action='store_true',
+            help='Log the time, downloads and queries of every stage.')
+        parser.add_argument(
+            '--metrics-file',
+            default=getattr(settings, 'FETCH_METRICS_FILE', None),
+            help='Write the metrics to this file in the Prometheus text format. '
+                 'Implies --metrics.')
+        parser.add_argument(
+            '--trace-memory', action='store_true',
+            help='Include the memory peak of every stage in the metrics. '
+                 'This slows down the run considerably.')
+
     def handle(self, *args, **options):
         """Update the cache."""
-        for canteen_name, canteen_callable, canteen_kwargs in settings.CANTEENS:
-            canteen_result = canteen_callable(**canteen_kwargs)
-            store_canteen_data(
-                canteen_name, canteen_result)
+        with ExitStack() as stack:
+            recorder = None
+            if options['metrics'] or options['metrics_file'] or options['trace_memory']:
+                recorder = stack.enter_context(
+                    instrumentation.recording(options['trace_memory']))
+
+            fetch_canteens(workers=options['workers'], force=options['force'])
+
+            # send notifications for today
+            with instrumentation.stage('notify'):
+                send_notifications()
 
-        # send notifications for today
-        send_notifications()
+            if recorder is not None and options['metrics_file']:
+                recorder.write_textfile(options['metrics_file'])
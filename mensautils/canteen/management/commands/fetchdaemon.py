@@ -0,0 +1,28 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from mensautils.canteen.fetching import build_jobs
+from mensautils.canteen.scheduling import Scheduler
+
+
+class Command(BaseCommand):
+    help = 'Fetch the canteen data continuously, adapted to the opening times.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            default=getattr(settings, 'FETCH_WORKERS', 1),
+            help='Number of sources to fetch concurrently.')
+
+    def handle(self, *args, **options):
+        jobs = build_jobs(settings.CANTEENS)
+        if not jobs:
+            raise CommandError('No canteens are configured.')
+
+        stop = threading.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *_: stop.set())
+        Scheduler(jobs, options['workers']).run(stop)
@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from mensautils.canteen.models import Serving
+from mensautils.canteen.statistics import rebuild_dish_statistics
+
+
+class Command(BaseCommand):
+    help = 'Recompute the counters of all servings and the dish statistics.'
+
+    def handle(self, *args, **options):
+        Serving.rebuild_counters()
+        rebuild_dish_statistics()
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from mensautils.canteen.outbox import send_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send the pending mails of the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            default=getattr(settings, 'MAIL_WORKERS', 4),
+            help='Number of connections used concurrently.')
+        parser.add_argument(
+            '--batch-size', type=int, default=20,
+            help='Number of mails sent using the same connection.')
+
+    def handle(self, *args, **options):
+        sent, failed = send_outbox(options['workers'], options['batch_size'])
+        if sent or failed:
+            self.stdout.write('Sent {} mails, {} failed.'.format(sent, failed))
@@ -0,0 +1,295 @@
+"""Fuzzy string matching backed by in-memory q-gram indexes.
+
+The indexes only prune strings which cannot reach the minimum ratio. The
+remaining candidates are still scored by fuzzywuzzy, so the results are
+the same as when scoring every string.
+"""
+import bisect
+import heapq
+import math
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from fuzzywuzzy import fuzz, utils
+
+# length of the indexed substrings
+Q = 3
+
+
+def token_sort_key(string: str) -> str:
+    """Get the normalized string compared by fuzz.token_sort_ratio."""
+    return ' '.join(sorted(utils.full_process(string, force_ascii=True).split()))
+
+
+def token_set_key(string: str) -> str:
+    """Get the normalized string compared by the token set ratios."""
+    return ' '.join(sorted(set(utils.full_process(string, force_ascii=True).split())))
+
+
+def _qgrams(key: str) -> Set[str]:
+    return {key[i:i + Q] for i in range(len(key) - Q + 1)}
+
+
+def _min_similarity(min_ratio: int) -> float:
+    """Get the smallest similarity fuzzywuzzy rounds up to min_ratio."""
+    return (min_ratio - 0.5) / 100 - 1e-9
+
+
+def _max_partial_distance(length: int, similarity: float) -> int:
+    """Get the edit distance allowed between a key and a part of another."""
+    return math.floor((1 - similarity) * 2 * length)
+
+
+class QGramIndex:
+    """Index of normalized keys by their q-grams.
+
+    Every inserted or deleted character destroys at most Q of the q-grams
+    of a string. Two keys within a given edit distance therefore share a
+    minimum number of q-grams, which is used to find the candidates.
+    """
+    def __init__(self):
+        self._keys = {}  # type: Dict[Hashable, str]
+        self._qgrams = defaultdict(set)
+        self._qgram_counts = {}  # type: Dict[Hashable, int]
+        self._tokens = defaultdict(set)
+        self._lengths = defaultdict(set)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, ident: Hashable) -> bool:
+        return ident in self._keys
+
+    def add(self, ident: Hashable, key: str):
+        self.discard(ident)
+        self._keys[ident] = key
+        qgrams = _qgrams(key)
+        for qgram in qgrams:
+            self._qgrams[qgram].add(ident)
+        self._qgram_counts[ident] = len(qgrams)
+        for token in key.split():
+            self._tokens[token].add(ident)
+        self._lengths[len(key)].add(ident)
+
+    def discard(self, ident: Hashable):
+        key = self._keys.pop(ident, None)
+        if key is None:
+            return
+        for qgram in _qgrams(key):
+            _remove(self._qgrams, qgram, ident)
+        del self._qgram_counts[ident]
+        for token in set(key.split()):
+            _remove(self._tokens, token, ident)
+        _remove(self._lengths, len(key), ident)
+
+    def candidates(self, key: str, min_ratio: int) -> Set[Hashable]:
+        """Get all keys which may reach min_ratio with key using fuzz.ratio."""
+        similarity = _min_similarity(min_ratio)
+        if similarity <= 0:
+            return set(self._keys)
+
+        # the ratio is (l1 + l2 - d) / (l1 + l2) with d >= |l1 - l2| being
+        # the number of inserted and deleted characters
+        length = len(key)
+        min_length = math.ceil(length * similarity / (2 - similarity))
+        max_length = math.floor(length * (2 - similarity) / similarity)
+        lengths = range(min_length, max_length + 1)
+
+        qgrams = _qgrams(key)
+        max_distance = math.floor((1 - similarity) * (length + max_length))
+        required = len(qgrams) - Q * max_distance
+        if required < 1:
+            # too short to guarantee a common q-gram
+            return set().union(*(self._lengths.get(l, ()) for l in lengths))
+
+        # keys sharing at least required q-grams have to contain one of the
+        # len(qgrams) - required + 1 rarest ones
+        postings = sorted((self._qgrams.get(qgram, set()) for qgram in qgrams),
+                          key=len)
+        candidates = set().union(*postings[:len(qgrams) - required + 1])
+        return {ident for ident in candidates
+                if min_length <= len(self._keys[ident]) <= max_length}
+
+    def partial_candidates(self, key: str, min_ratio: int) -> Set[Hashable]:
+        """Get all keys which may reach min_ratio with key using
+        fuzz.partial_token_set_ratio.
+
+        Both key and the indexed keys have to be built by token_set_key.
+        """
+        similarity = _min_similarity(min_ratio)
+        if similarity <= 0:
+            return set(self._keys)
+        if not key:
+            return set()
+
+        # keys sharing a token always have a ratio of 100
+        candidates = set().union(*(self._tokens.get(token, ()) for token in key.split()))
+
+        # otherwise, the shorter key has to be similar to a part of the
+        # longer one. Start with keys at least as long as key.
+        length = len(key)
+        qgrams = _qgrams(key)
+        required = len(qgrams) - Q * _max_partial_distance(length, similarity)
+        if required < 1:
+            candidates.update(ident for ident, other in self._keys.items()
+                              if len(other) >= length)
+        else:
+            postings = sorted((self._qgrams.get(qgram, set()) for qgram in qgrams),
+                              key=len)
+            candidates.update(
+                ident for ident in set().union(*postings[:len(qgrams) - required + 1])
+                if len(self._keys[ident]) >= length)
+
+        # shorter keys need to share enough of their own q-grams with key
+        shared = Counter()
+        for qgram in qgrams:
+            shared.update(self._qgrams.get(qgram, ()))
+        for other_length in range(length):
+            max_distance = _max_partial_distance(other_length, similarity)
+            for ident in self._lengths.get(other_length, ()):
+                if shared[ident] >= self._qgram_counts[ident] - Q * max_distance:
+                    candidates.add(ident)
+        return candidates
+
+
+def _remove(index: Dict[Hashable, Set], key: Hashable, ident: Hashable):
+    idents = index[key]
+    idents.discard(ident)
+    if not idents:
+        del index[key]
+
+
+class DishMatcher:
+    """Index of all dishes used by Dish.fuzzy_find_or_create and the dish
+    search.
+
+    The matcher is kept for the lifetime of the process. Dishes created by
+    other processes are loaded by passing the rows with a primary key above
+    max_pk to load().
+    """
+    def __init__(self):
+        self.max_pk = 0
+        self._lock = threading.RLock()
+        self._dishes = {}  # type: Dict[int, Tuple[str, Tuple[bool, bool], str]]
+        self._exact = defaultdict(set)
+        self._indexes = defaultdict(QGramIndex)
+        # tokens of the dish names, sorted and indexed, and the dishes
+        # containing them
+        self._tokens = []  # type: List[str]
+        self._vocabulary = QGramIndex()
+        self._postings = defaultdict(set)
+
+    def load(self, dishes: Iterable[Tuple[int, str, bool, bool]]):
+        with self._lock:
+            for pk, name, vegetarian, vegan in dishes:
+                self.add(pk, name, vegetarian, vegan)
+                self.max_pk = max(self.max_pk, pk)
+
+    def add(self, pk: int, name: str, vegetarian: bool, vegan: bool):
+        with self._lock:
+            self.discard(pk)
+            flags = bool(vegetarian), bool(vegan)
+            key = token_sort_key(name)
+            self._dishes[pk] = name, flags, key
+            self._exact[(key,) + flags].add(pk)
+            self._indexes[flags].add(pk, key)
+            for token in token_set_key(name).split():
+                if token not in self._postings:
+                    bisect.insort(self._tokens, token)
+                    self._vocabulary.add(token, token)
+                self._postings[token].add(pk)
+
+    def discard(self, pk: int):
+        with self._lock:
+            if pk not in self._dishes:
+                return
+            name, flags, key = self._dishes.pop(pk)
+            _remove(self._exact, (key,) + flags, pk)
+            self._indexes[flags].discard(pk)
+            for token in token_set_key(name).split():
+                _remove(self._postings, token, pk)
+                if token not in self._postings:
+                    del self._tokens[bisect.bisect_left(self._tokens, token)]
+                    self._vocabulary.discard(token)
+
+    def match(self, name: str, vegetarian: bool, vegan: bool,
+              min_ratio: int) -> Optional[int]:
+        """Get the oldest dish reaching min_ratio with fuzz.token_sort_ratio.
+
+        Dishes are compared in the order of their primary keys, just like
+        scanning the dish table does.
+        """
+        flags = bool(vegetarian), bool(vegan)
+        key = token_sort_key(name)
+        with self._lock:
+            # identical keys always have a ratio of 100
+            exact = self._exact.get((key,) + flags)
+            best = min(exact) if exact and min_ratio <= 100 else None
+            for pk in self._indexes[flags].candidates(key, min_ratio):
+                if best is not None and pk >= best:
+                    continue
+                # same as fuzz.token_sort_ratio on the names
+                if fuzz.ratio(key, self._dishes[pk][2]) >= min_ratio:
+                    best = pk
+            return best
+
+    def search(self, query: str, min_ratio: int, limit: Optional[int] = None,
+               allowed_pks: Optional[Set[int]] = None) -> List[Tuple[int, int]]:
+        """Get the best dishes matching a query and their scores.
+
+        Every token of the query has to match a token of the name. Tokens
+        starting with the query token score 100, other ones fuzz.ratio if
+        it reaches min_ratio. The score of a dish is the mean of the best
+        scores of the query tokens. Dishes with the same score are ranked by
+        the mean fuzz.ratio of the tokens, so whole words come first. If
+        allowed_pks is given, only these dishes are returned.
+        """
+        query_tokens = token_set_key(query).split()
+        if not query_tokens:
+            return []
+
+        with self._lock:
+            # scores and ratios of the matching tokens of every query token
+            matching = []
+            for query_token in query_tokens:
+                scores = {}  # type: Dict[str, Tuple[int, int]]
+                start = bisect.bisect_left(self._tokens, query_token)
+                for token in self._tokens[start:]:
+                    if not token.startswith(query_token):
+                        break
+                    scores[token] = 100, fuzz.ratio(query_token, token)
+                for token in self._vocabulary.candidates(query_token, min_ratio):
+                    if token not in scores:
+                        ratio = fuzz.ratio(query_token, token)
+                        if ratio >= min_ratio:
+                            scores[token] = ratio, ratio
+                matching.append(scores)
+            # start with the query token matching the fewest dishes
+            matching.sort(key=lambda scores: sum(
+                len(self._postings[token]) for token in scores))
+
+            totals = None  # type: Optional[Dict[int, Tuple[int, int]]]
+            for scores in matching:
+                best = {}  # type: Dict[int, Tuple[int, int]]
+                for token, ratios in scores.items():
+                    pks = self._postings[token]
+                    if totals is not None:
+                        pks = pks & totals.keys()
+                    elif allowed_pks is not None:
+                        pks = pks & allowed_pks
+                    for pk in pks:
+                        if ratios > best.get(pk, (0, 0)):
+                            best[pk] = ratios
+                if totals is None:
+                    totals = best
+                else:
+                    totals = {pk: (totals[pk][0] + score, totals[pk][1] + ratio)
+                              for pk, (score, ratio) in best.items()}
+
+        ranked = ((-score, -ratio, pk) for pk, (score, ratio) in totals.items())
+        ranked = sorted(ranked) if limit is None else heapq.nsmallest(limit, ranked)
+        return [(pk, round(-score / len(query_tokens))) for score, _, pk in ranked]
+
+
+dish_matcher = DishMatcher()
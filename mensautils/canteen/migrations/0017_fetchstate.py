@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0016_dish_vegan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FetchState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=300, unique=True)),
+                ('etag', models.CharField(blank=True, max_length=300)),
+                ('last_modified', models.CharField(blank=True, max_length=100)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('last_fetched', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
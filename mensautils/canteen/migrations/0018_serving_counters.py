@@ -0,0 +1,54 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:42
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_related(apps, schema_editor):
+    Serving = apps.get_model('canteen', 'Serving')
+    Rating = apps.get_model('canteen', 'Rating')
+    ServingVerification = apps.get_model('canteen', 'ServingVerification')
+    InofficialDeprecation = apps.get_model('canteen', 'InofficialDeprecation')
+    Serving.objects.update(**{
+        field: Coalesce(Subquery(
+            related.objects.filter(serving=OuterRef('pk')).order_by().values(
+                'serving').annotate(value=aggregate).values('value')), 0)
+        for field, related, aggregate in (
+            ('rating_sum', Rating, Sum('rating')),
+            ('rating_count', Rating, Count('pk')),
+            ('verifications_count', ServingVerification, Count('pk')),
+            ('deprecation_reports_count', InofficialDeprecation, Count('pk')),
+        )
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0017_fetchstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serving',
+            name='deprecation_reports_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='serving',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='serving',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='serving',
+            name='verifications_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_related, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+
+def compute_statistics(apps, schema_editor):
+    Dish = apps.get_model('canteen', 'Dish')
+    DishStatistics = apps.get_model('canteen', 'DishStatistics')
+    totals = Dish.objects.annotate(
+        serving_count=Count('servings'),
+        rating_count=Coalesce(Sum('servings__rating_count'), 0),
+        rating_sum=Coalesce(Sum('servings__rating_sum'), 0)).values_list(
+        'pk', 'serving_count', 'rating_count', 'rating_sum')
+    DishStatistics.objects.bulk_create([
+        DishStatistics(dish_id=dish_pk, serving_count=serving_count,
+                       rating_count=rating_count, rating_sum=rating_sum)
+        for dish_pk, serving_count, rating_count, rating_sum in totals])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0018_serving_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DishStatistics',
+            fields=[
+                ('dish', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='statistics', serialize=False, to='canteen.dish')),
+                ('serving_count', models.IntegerField(db_index=True, default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(compute_statistics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0019_dishstatistics'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='serving',
+            index=models.Index(fields=['date', 'canteen', 'dish'], name='serving_date_canteen_dish'),
+        ),
+        migrations.AddIndex(
+            model_name='serving',
+            index=models.Index(fields=['date', 'notified'], name='serving_date_notified'),
+        ),
+        migrations.AddIndex(
+            model_name='serving',
+            index=models.Index(fields=['last_updated'], name='serving_last_updated'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:59
+
+from datetime import date
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def queue_unnotified_servings(apps, schema_editor):
+    Serving = apps.get_model('canteen', 'Serving')
+    QueuedServing = apps.get_model('canteen', 'QueuedServing')
+    QueuedServing.objects.bulk_create([
+        QueuedServing(serving_id=serving_pk)
+        for serving_pk in Serving.objects.filter(
+            date__gte=date.today(), notified=False).values_list('pk', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0020_serving_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedServing',
+            fields=[
+                ('serving', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='queued_notification', serialize=False, to='canteen.serving')),
+                ('added', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(queue_unnotified_servings, migrations.RunPython.noop),
+    ]
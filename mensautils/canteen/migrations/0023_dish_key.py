@@ -0,0 +1,42 @@
+# Generated by Django 3.1.14 on 2026-10-18 11:13
+
+import re
+
+from django.db import migrations, models
+
+
+def token_sort_key(name):
+    """Copy of matching.token_sort_key at the time of this migration."""
+    # utils.full_process(name, force_ascii=True) of fuzzywuzzy, which only
+    # removes the characters from 128 to 255
+    name = ''.join(char for char in name if not 128 <= ord(char) < 256)
+    name = re.sub(r'(?ui)\W', ' ', name).lower().strip()
+    return ' '.join(sorted(name.split()))
+
+
+def set_dish_keys(apps, schema_editor):
+    Dish = apps.get_model('canteen', 'Dish')
+    dishes = list(Dish.objects.only('pk', 'name'))
+    for dish in dishes:
+        dish.key = token_sort_key(dish.name)
+    Dish.objects.bulk_update(dishes, ['key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0022_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dish',
+            name='key',
+            field=models.CharField(default='', editable=False, max_length=300),
+        ),
+        migrations.RunPython(set_dish_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='dish',
+            index=models.Index(fields=['key', 'vegetarian', 'vegan'], name='dish_key_flags'),
+        ),
+    ]
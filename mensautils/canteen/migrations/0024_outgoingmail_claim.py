@@ -0,0 +1,22 @@
+# Generated by Django 3.1.14 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canteen', '0023_dish_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='claim',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmail',
+            index=models.Index(fields=['claim'], name='outgoingmail_claim'),
+        ),
+    ]
@@ -1,27 +1,112 @@
 from django.conf import settings
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.core.cache import cache
 from django.db import models
-from django.db.models import Avg, Count
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from fuzzywuzzy import fuzz
+from typing import Dict, List, Optional, Tuple
+
+from mensautils.canteen.caching import get_canteen_version
+from mensautils.canteen.matching import dish_matcher, token_sort_key
 
 
 class Dish(models.Model):
+    class Meta:
+        indexes = [
+            # exact matches of incoming dishes
+            models.Index(fields=['key', 'vegetarian', 'vegan'],
+                         name='dish_key_flags'),
+        ]
+
     name = models.CharField(verbose_name=_('name'), max_length=300)
     vegetarian = models.BooleanField()
     vegan = models.BooleanField()
+    # normalized name compared by fuzz.token_sort_ratio, set on save
+    key = models.CharField(max_length=300, editable=False, default='')
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.key = token_sort_key(self.name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'name' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'key'}
+        super().save(*args, **kwargs)
+
     @staticmethod
     def fuzzy_find_or_create(name: str, vegetarian: bool, vegan: bool) -> 'Dish':
-        for dish in Dish.objects.filter(vegetarian=vegetarian, vegan=vegan):
-            if fuzz.token_sort_ratio(name, dish.name) >= settings.FUZZY_MIN_RATIO:
-                return dish
+        """Find a dish with the same key, else the oldest similar one, or
+        create it.
+        """
+        dish = Dish.objects.filter(
+            key=token_sort_key(name), vegetarian=vegetarian, vegan=vegan).order_by(
+            'pk').first()
+        if dish is not None:
+            return dish
+
+        while True:
+            Dish.sync_matcher()
+            pk = dish_matcher.match(
+                name, vegetarian, vegan, settings.FUZZY_MIN_RATIO)
+            if pk is None:
+                break
+            try:
+                return Dish.objects.get(pk=pk)
+            except Dish.DoesNotExist:
+                # deleted by another process
+                dish_matcher.discard(pk)
         return Dish.objects.create(name=name, vegetarian=vegetarian, vegan=vegan)
 
+    @staticmethod
+    def fuzzy_find_or_create_pks(dishes: List[Tuple[str, bool, bool]]) -> List[int]:
+        """Find or create many dishes at once and get their primary keys.
+
+        The dishes are given as (name, vegetarian, vegan) tuples. Dishes with
+        the same key are found with a single query, only the remaining ones
+        are matched fuzzily. Unless new dishes have to be created, a
+        constant number of queries is used.
+        """
+        keys = [(token_sort_key(name), bool(vegetarian), bool(vegan))
+                for name, vegetarian, vegan in dishes]
+        exact = {}  # type: Dict[Tuple[str, bool, bool], int]
+        # the oldest dish of every key is stored last
+        for pk, key, vegetarian, vegan in Dish.objects.filter(
+                key__in={key for key, _, _ in keys}).order_by('-pk').values_list(
+                'pk', 'key', 'vegetarian', 'vegan'):
+            exact[(key, vegetarian, vegan)] = pk
+
+        misses = {dish for dish, key in zip(dishes, keys) if key not in exact}
+        matches = {}  # type: Dict[Tuple[str, bool, bool], Optional[int]]
+        existing = set()
+        if misses:
+            Dish.sync_matcher()
+            matches = {dish: dish_matcher.match(*dish, settings.FUZZY_MIN_RATIO)
+                       for dish in misses}
+            existing = set(Dish.objects.filter(
+                pk__in={pk for pk in matches.values() if pk is not None}).values_list(
+                'pk', flat=True))
+
+        pks = []
+        for dish, key in zip(dishes, keys):
+            pk = exact.get(key)
+            if pk is None:
+                pk = matches[dish]
+                if pk not in existing:
+                    # new dish or deleted by another process
+                    pk = Dish.fuzzy_find_or_create(*dish).pk
+                    exact[key] = pk
+            pks.append(pk)
+        return pks
+
+    @staticmethod
+    def sync_matcher():
+        """Add dishes created by other processes to the matcher."""
+        dish_matcher.load(Dish.objects.filter(pk__gt=dish_matcher.max_pk).values_list(
+            'pk', 'name', 'vegetarian', 'vegan'))
+
 
 class Canteen(models.Model):
     name = models.CharField(verbose_name=_('name'), max_length=100)
@@ -31,6 +116,10 @@ class Canteen(models.Model):
         return self.name
 
 
+# seconds the opening times are cached
+OPENING_TIMES_CACHE_TIMEOUT = 24 * 60 * 60
+
+
 class OpeningTime(models.Model):
     class Meta:
         unique_together = ['canteen', 'weekday']
@@ -46,9 +135,20 @@ class OpeningTime(models.Model):
             self.canteen.name, self.weekday, self.start, self.end)
 
     @staticmethod
-    def get_opening_time(canteen: Canteen, weekday: int) -> 'OpeningTime':
-        """Get the opening time of a canteen on a weekday."""
-        pass
+    def get_opening_time(canteen: Canteen, weekday: int) -> Optional['OpeningTime']:
+        """Get the opening time of a canteen on a weekday.
+
+        The opening times of all canteens are cached until the canteen
+        version changes.
+        """
+        key = 'mensautils:opening-times:{}'.format(get_canteen_version())
+        opening_times = cache.get(key)
+        if opening_times is None:
+            opening_times = {
+                (opening_time.canteen_id, opening_time.weekday): opening_time
+                for opening_time in OpeningTime.objects.all()}
+            cache.set(key, opening_times, OPENING_TIMES_CACHE_TIMEOUT)
+        return opening_times.get((canteen.pk, weekday))
 
 
 class CanteenUserConfig(models.Model):
@@ -63,6 +163,19 @@ class CanteenUserConfig(models.Model):
 
 
 class Serving(models.Model):
+    class Meta:
+        indexes = [
+            # plans of days, servings of a canteen and the archiver
+            models.Index(fields=['date', 'canteen', 'dish'],
+                         name='serving_date_canteen_dish'),
+            # servings to notify about
+            models.Index(fields=['date', 'notified'],
+                         name='serving_date_notified'),
+            # time of the last update
+            models.Index(fields=['last_updated'],
+                         name='serving_last_updated'),
+        ]
+
     date = models.DateField()
     dish = models.ForeignKey(
         Dish, on_delete=models.CASCADE, related_name='servings')
@@ -76,49 +189,53 @@ class Serving(models.Model):
     officially_deprecated = models.BooleanField(default=False)
     notified = models.BooleanField(default=False)
 
+    # counters of related rows, maintained by signal handlers
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    verifications_count = models.IntegerField(default=0)
+    deprecation_reports_count = models.IntegerField(default=0)
+
     def __str__(self):
         return '{}: {} ({}, {})'.format(self.canteen, str(self.dish), str(self.date),
                                         self.price)
 
-    def average_rating(self) -> float:
+    def average_rating(self) -> Optional[float]:
         """Get average rating."""
-        if hasattr(self, 'ratings__rating__avg'):
-            return self.ratings__rating__avg
-        return self.ratings.aggregate(Avg('rating'))['rating__avg']
-
-    def rating_count(self) -> int:
-        """Get rating count."""
-        if hasattr(self, 'ratings__count'):
-            return self.ratings__count
-        return self.ratings.count()
-
-    def verifications_count(self):
-        if hasattr(self, 'verifications__count'):
-            return self.verifications__count
-        else:
-            return self.verifications.count
-
-    def deprecation_reports_count(self):
-        if hasattr(self, 'deprecation_reports__count'):
-            return self.deprecation_reports__count
-        else:
-            return self.aggregate(
-                Count('deprecation_reports'))['deprecation_reports__count']
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
+    @staticmethod
+    def rebuild_counters(servings: Optional[models.QuerySet] = None):
+        """Recompute the counters of servings from the related rows."""
+        if servings is None:
+            servings = Serving.objects.all()
+        servings.update(**{
+            field: Coalesce(Subquery(
+                related.objects.filter(serving=OuterRef('pk')).order_by().values(
+                    'serving').annotate(value=aggregate).values('value')), 0)
+            for field, related, aggregate in (
+                ('rating_sum', Rating, Sum('rating')),
+                ('rating_count', Rating, Count('pk')),
+                ('verifications_count', ServingVerification, Count('pk')),
+                ('deprecation_reports_count', InofficialDeprecation, Count('pk')),
+            )
+        })
 
     @property
     def verified(self) -> bool:
         return (self.official or
-                self.verifications_count() >= settings.MIN_REPORTS)
+                self.verifications_count >= settings.MIN_REPORTS)
 
     @property
     def deprecated(self) -> bool:
         return (self.officially_deprecated or
-                self.deprecation_reports_count() >= settings.MIN_REPORTS)
+                self.deprecation_reports_count >= settings.MIN_REPORTS)
 
     @property
     def maybe_deprecated(self) -> bool:
         """Maybe deprecated when at least one user has reported serving."""
-        reports = self.deprecation_reports_count()
+        reports = self.deprecation_reports_count
         return reports >= 1
 
 
@@ -179,3 +296,67 @@ class Notification(models.Model):
 
     def __str__(self):
         return '{} ({})'.format(self.pattern, self.user)
+
+
+class QueuedServing(models.Model):
+    """Serving which has not been matched against the notifications yet."""
+    serving = models.OneToOneField(
+        Serving, on_delete=models.CASCADE, primary_key=True,
+        related_name='queued_notification')
+    added = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.serving)
+
+
+class OutgoingMail(models.Model):
+    """Mail waiting to be sent by the sendoutbox command."""
+    class Meta:
+        indexes = [
+            # pending mails and old sent mails
+            models.Index(fields=['sent', 'next_attempt'],
+                         name='outgoingmail_sent_attempt'),
+            models.Index(fields=['claim'], name='outgoingmail_claim'),
+        ]
+
+    subject = models.CharField(max_length=300)
+    message = models.TextField()
+    from_address = models.CharField(max_length=300)
+    recipient = models.CharField(max_length=300)
+
+    created = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+    # run of the sendoutbox command which is sending the mail
+    claim = models.UUIDField(null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return '{} ({})'.format(self.subject, self.recipient)
+
+
+class FetchState(models.Model):
+    """Validators of a fetched source page for conditional requests."""
+    url = models.CharField(max_length=300, unique=True)
+    etag = models.CharField(max_length=300, blank=True)
+    last_modified = models.CharField(max_length=100, blank=True)
+    content_hash = models.CharField(max_length=64)
+    last_fetched = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.url
+
+
+class DishStatistics(models.Model):
+    """Serving and rating totals of a dish, maintained incrementally."""
+    dish = models.OneToOneField(
+        Dish, on_delete=models.CASCADE, primary_key=True,
+        related_name='statistics')
+    serving_count = models.IntegerField(default=0, db_index=True)
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {} servings, {} ratings'.format(
+            self.dish, self.serving_count, self.rating_count)
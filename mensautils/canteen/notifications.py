@@ -1,23 +1,52 @@
 from datetime import date
+from typing import Dict, Iterable, Set
 
 from django.conf import settings
-from django.core.mail import send_mail
+from django.db import transaction
 from django.utils import timezone
 from fuzzywuzzy import fuzz
 
-from mensautils.canteen.models import Serving, Notification
+from mensautils.canteen.matching import QGramIndex, token_set_key
+from mensautils.canteen.models import Notification, OutgoingMail, QueuedServing, \
+    Serving
+from mensautils.canteen.outbox import queue_mail
+
+
+def queue_notifications(serving_pks: Iterable[int]):
+    """Queue new servings to be matched by the next send_notifications()."""
+    QueuedServing.objects.bulk_create(
+        [QueuedServing(serving_id=serving_pk) for serving_pk in serving_pks],
+        ignore_conflicts=True)
 
 
 def send_notifications():
+    """Notify about the queued servings of today.
+
+    Queued servings of past days are dropped, those of later days are kept
+    until their day. The mails are stored in the outbox together with
+    marking the servings as notified.
+    """
     now = timezone.now()
     today = date.today()
-    relevant_servings = Serving.objects.filter(date=today, notified=False)
+    QueuedServing.objects.filter(serving__date__lt=today).delete()
+    queued = QueuedServing.objects.filter(serving__date=today)
+    relevant_servings = [entry.serving for entry in queued.select_related(
+        'serving__dish', 'serving__canteen').order_by('pk')]
+    if not relevant_servings:
+        return
     notification_objs = Notification.objects.all()
+    notifications = list(notification_objs.select_related('user').order_by('pk'))
+
+    matches = match_patterns(
+        {notification.pattern for notification in notifications},
+        {serving.dish.name for serving in relevant_servings})
+
+    mails = []
     notified = set()
-    for notification in notification_objs:
-        for serving in relevant_servings.all():
-            if (fuzz.partial_token_set_ratio(serving.dish.name, notification.pattern) >=
-               settings.FUZZY_MIN_RATIO):
+    for notification in notifications:
+        matching_names = matches[notification.pattern]
+        for serving in relevant_servings:
+            if serving.dish.name in matching_names:
                 subject = 'Mensabenachrichtigung: {} in {}'.format(
                     serving.dish.name, serving.canteen.name)
                 message = '''Das Gericht {} wird heute in der Mensa {} zu einem Preis von {} € angeboten.
@@ -26,9 +55,40 @@ Du erhältst diese Nachricht, weil Du unter https://mensa.mafiasi.de eine
 Benchrichtigung mit der Suchregel "{}" angelegt hast.'''.format(
                     serving.dish.name, serving.canteen.name, serving.price,
                     notification.pattern)
-                send_mail(subject, message, settings.NOTIFICATION_FROM_ADDRESS,
-                          [notification.user.email], fail_silently=False)
+                mails.append(queue_mail(subject, message,
+                                        settings.NOTIFICATION_FROM_ADDRESS,
+                                        notification.user.email))
                 notified.add(notification.pk)
                 break  # skip more notifications for this user notification
-    notification_objs.filter(pk__in=notified).update(last_notified=now)
-    relevant_servings.update(notified=True)
+    serving_pks = [serving.pk for serving in relevant_servings]
+    with transaction.atomic():
+        OutgoingMail.objects.bulk_create(mails)
+        notification_objs.filter(pk__in=notified).update(last_notified=now)
+        Serving.objects.filter(pk__in=serving_pks).update(notified=True)
+        QueuedServing.objects.filter(pk__in=serving_pks).delete()
+
+
+def match_patterns(patterns: Iterable[str], names: Iterable[str]) -> Dict[str, Set[str]]:
+    """Get the dish names matching each notification pattern.
+
+    Every pair of pattern and name is compared at most once, and only if
+    the q-gram index cannot rule out a match.
+    """
+    names = list(names)
+    index = QGramIndex()
+    for i, name in enumerate(names):
+        index.add(i, token_set_key(name))
+
+    matches = {}
+    for pattern in patterns:
+        pattern_key = token_set_key(pattern)
+        pattern_tokens = set(pattern_key.split())
+        matches[pattern] = set()
+        for i in index.partial_candidates(pattern_key, settings.FUZZY_MIN_RATIO):
+            name = names[i]
+            # common tokens always result in a ratio of 100
+            if (pattern_tokens.intersection(token_set_key(name).split()) or
+                    fuzz.partial_token_set_ratio(name, pattern) >=
+                    settings.FUZZY_MIN_RATIO):
+                matches[pattern].add(name)
+    return matches
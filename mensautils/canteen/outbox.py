@@ -0,0 +1,133 @@
+"""Sending of the mails stored in the outbox.
+
+Mails are stored as OutgoingMail rows by the code creating them and sent
+later by the sendoutbox command, so that slow or failing mail servers do
+not affect the fetch runs. Each mail is marked as sent on its own and
+failed mails are retried with an exponential backoff.
+
+A run claims the pending mails before sending them, so overlapping runs
+never send the same mail. Mails claimed by a run which died are sent again
+once the claim has expired.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection
+from django.utils import timezone
+
+from mensautils.canteen.models import OutgoingMail
+
+# number of attempts after which a mail is given up
+MAX_ATTEMPTS = 8
+
+# seconds to wait before the first retry, doubled for every further one
+RETRY_DELAY = 60
+
+# days sent mails are kept
+SENT_RETENTION = 30
+
+# seconds after which mails claimed by a run may be sent by another one
+CLAIM_TIMEOUT = 30 * 60
+
+
+def queue_mail(subject: str, message: str, from_address: str,
+               recipient: str) -> OutgoingMail:
+    """Create an unsaved mail, which is sent once it has been saved."""
+    return OutgoingMail(subject=subject, message=message,
+                        from_address=from_address, recipient=recipient)
+
+
+def send_outbox(workers: int = 4, batch_size: int = 20) -> Tuple[int, int]:
+    """Send all pending mails and return the numbers of sent and failed ones.
+
+    The mails are sent in batches using one connection each, with up to
+    workers batches being sent concurrently by threads.
+    """
+    now = timezone.now()
+    OutgoingMail.objects.filter(
+        sent__lt=now - timedelta(days=SENT_RETENTION)).delete()
+    pending = _claim_pending(now)
+    batches = [pending[start:start + batch_size]
+               for start in range(0, len(pending), batch_size)]
+
+    sent_count = 0
+    failed_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_send_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            sent, failed = future.result()
+            sent_count += sent
+            failed_count += failed
+    return sent_count, failed_count
+
+
+def _claim_pending(now: datetime) -> List[OutgoingMail]:
+    """Claim the pending mails for this run and return them.
+
+    The claim is a single update, so mails claimed by a concurrent run are
+    skipped. Claimed mails are not pending again until CLAIM_TIMEOUT.
+    """
+    claim = uuid.uuid4()
+    OutgoingMail.objects.filter(
+        sent=None, next_attempt__lte=now, attempts__lt=MAX_ATTEMPTS).update(
+        claim=claim, next_attempt=now + timedelta(seconds=CLAIM_TIMEOUT))
+    return list(OutgoingMail.objects.filter(claim=claim, sent=None).order_by('pk'))
+
+
+def _send_batch(mails: List[OutgoingMail]) -> Tuple[int, int]:
+    """Send mails over one connection and return the numbers of sent and
+    failed ones.
+
+    Every mail is marked as sent or failed right after sending it, so mails
+    are not sent again if the run dies before the batch is done.
+    """
+    mail_connection = get_connection(fail_silently=False)
+    sent_count = 0
+    failed_count = 0
+    try:
+        for mail in mails:
+            try:
+                # the backend would open and close a connection for every
+                # message otherwise, opening an open connection does nothing
+                mail_connection.open()
+                mail_connection.send_messages([EmailMessage(
+                    mail.subject, mail.message, mail.from_address,
+                    [mail.recipient])])
+            except Exception as e:
+                _store_result(mail, '{}: {}'.format(type(e).__name__, e))
+                failed_count += 1
+                # the connection may be broken, a new one is opened for the
+                # next mail
+                _close(mail_connection)
+            else:
+                _store_result(mail, None)
+                sent_count += 1
+    finally:
+        _close(mail_connection)
+        # the database connection of this thread is not reused
+        if threading.current_thread() is not threading.main_thread():
+            connection.close()
+    return sent_count, failed_count
+
+
+def _close(mail_connection):
+    try:
+        mail_connection.close()
+    except Exception:
+        pass
+
+
+def _store_result(mail: OutgoingMail, error: Optional[str]):
+    now = timezone.now()
+    if error is None:
+        OutgoingMail.objects.filter(pk=mail.pk).update(sent=now, last_error='')
+        return
+    mail.attempts += 1
+    mail.last_error = error
+    mail.next_attempt = now + timedelta(
+        seconds=RETRY_DELAY * 2 ** (mail.attempts - 1))
+    mail.save(update_fields=['attempts', 'last_error', 'next_attempt'])
@@ -0,0 +1,229 @@
+"""Performance metrics of the requests served by this process.
+
+PerformanceMiddleware measures the queries, the template rendering and the
+remaining time of every request. It reports them in the Server-Timing
+header, logs slow requests and keeps the latest measurements of every view
+for the percentiles shown by performance_report().
+
+Every worker process keeps its measurements in memory and publishes them
+to the shared cache at most every PUBLISH_INTERVAL seconds, so the report
+covers all workers which served requests recently.
+
+Template rendering is only measured if TimedDjangoTemplates is used as the
+template backend.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connection
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# number of queries logged for a slow request
+SLOW_REQUEST_QUERIES = 5
+
+# percentiles reported for every view
+PERCENTILES = (50, 90, 99)
+
+# seconds between publishing the measurements of a worker to the cache
+PUBLISH_INTERVAL = 10
+
+# seconds the published measurements of a worker are kept
+PUBLISH_TIMEOUT = 60 * 60
+
+WORKERS_KEY = 'mensautils:performance:workers'
+SAMPLES_KEY = 'mensautils:performance:samples:{}'
+
+_local = threading.local()
+
+# latest measurements of every view
+_samples = defaultdict(
+    lambda: deque(maxlen=getattr(settings, 'PERFORMANCE_SAMPLES', 1000))
+)  # type: Dict[str, Deque[Tuple[float, float, float, int]]]
+_samples_lock = threading.Lock()
+_last_published = 0.0
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = []  # type: List[Tuple[float, str]]
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.query_seconds += duration
+            self.queries.append((duration, sql))
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        metrics = RequestMetrics()
+        _local.metrics = metrics
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics.record_query):
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        total = time.perf_counter() - start
+        # time spent in the views and everything else which is not a query
+        # or template rendering
+        view = total - metrics.query_seconds - metrics.template_seconds
+
+        response['Server-Timing'] = ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(
+                metrics.query_seconds * 1000, len(metrics.queries)),
+            'template;dur={:.1f}'.format(metrics.template_seconds * 1000),
+            'view;dur={:.1f}'.format(view * 1000),
+            'total;dur={:.1f}'.format(total * 1000),
+        ])
+
+        view_name = _get_view_name(request)
+        if view_name is not None:
+            with _samples_lock:
+                _samples[view_name].append((
+                    total, metrics.query_seconds, metrics.template_seconds,
+                    len(metrics.queries)))
+            if time.monotonic() - _last_published >= PUBLISH_INTERVAL:
+                publish_samples()
+
+        if total * 1000 >= getattr(settings, 'PERFORMANCE_SLOW_REQUEST_MS', 500):
+            _log_slow_request(request, view_name, total, metrics)
+        return response
+
+
+def _get_view_name(request: HttpRequest) -> Optional[str]:
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return None
+    return resolver_match.view_name
+
+
+def _log_slow_request(request: HttpRequest, view_name: Optional[str], total: float,
+                      metrics: RequestMetrics):
+    slowest = sorted(metrics.queries, key=lambda query: query[0], reverse=True)
+    logger.warning(
+        'Slow request %s %s (%s) took %.0f ms: %d queries in %.0f ms, '
+        'templates %.0f ms%s', request.method, request.get_full_path(), view_name,
+        total * 1000, len(metrics.queries), metrics.query_seconds * 1000,
+        metrics.template_seconds * 1000, ''.join(
+            '\n  {:.1f} ms: {}'.format(duration * 1000, sql)
+            for duration, sql in slowest[:SLOW_REQUEST_QUERIES]))
+
+
+class TimedTemplate:
+    """Template of the Django backend which measures its rendering."""
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = getattr(_local, 'metrics', None)
+        if metrics is None:
+            return self.template.render(context, request)
+
+        # templates rendered while rendering another one are already measured
+        metrics.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            if not metrics.template_depth:
+                metrics.template_seconds += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend measuring the rendering for the middleware."""
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def _get_worker() -> str:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def publish_samples():
+    """Store the measurements of this worker in the cache."""
+    global _last_published
+    with _samples_lock:
+        _last_published = time.monotonic()
+        samples = {view_name: list(view_samples)
+                   for view_name, view_samples in _samples.items()}
+    worker = _get_worker()
+    cache.set(SAMPLES_KEY.format(worker), samples, PUBLISH_TIMEOUT)
+    # the list may lose workers added concurrently, they add themselves
+    # again when publishing the next time
+    workers = cache.get(WORKERS_KEY, [])
+    if worker not in workers:
+        cache.set(WORKERS_KEY, workers + [worker], None)
+
+
+def get_published_samples() -> Tuple[int, Dict[str, List[Tuple[float, float, float, int]]]]:
+    """Get the number of workers and the measurements of all of them."""
+    workers = cache.get(WORKERS_KEY, [])
+    published = cache.get_many([SAMPLES_KEY.format(worker) for worker in workers])
+    if len(published) < len(workers):
+        # forget the workers whose measurements expired
+        cache.set(WORKERS_KEY, [worker for worker in workers
+                                if SAMPLES_KEY.format(worker) in published], None)
+
+    samples = defaultdict(list)
+    for worker_samples in published.values():
+        for view_name, view_samples in worker_samples.items():
+            samples[view_name].extend(view_samples)
+    return len(published), samples
+
+
+def _percentile(values: List[float], percentile: int) -> float:
+    """Get a percentile of sorted values using the nearest rank."""
+    rank = max(1, -(-len(values) * percentile // 100))
+    return values[rank - 1]
+
+
+@staff_member_required
+def performance_report(request: HttpRequest) -> JsonResponse:
+    """Get percentiles of the latest requests of every view served by any
+    worker process.
+    """
+    publish_samples()
+    workers, samples = get_published_samples()
+
+    views = {}
+    for view_name, view_samples in sorted(samples.items()):
+        columns = {
+            'total_ms': sorted(sample[0] * 1000 for sample in view_samples),
+            'db_ms': sorted(sample[1] * 1000 for sample in view_samples),
+            'template_ms': sorted(sample[2] * 1000 for sample in view_samples),
+            'queries': sorted(sample[3] for sample in view_samples),
+        }
+        views[view_name] = {'requests': len(view_samples)}
+        for column, values in columns.items():
+            views[view_name][column] = {
+                'p{}'.format(percentile): round(_percentile(values, percentile), 1)
+                for percentile in PERCENTILES}
+    return JsonResponse({'workers': workers, 'views': views})
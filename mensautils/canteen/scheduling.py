@@ -0,0 +1,160 @@
+"""Adaptive schedule of the fetches run by the fetchdaemon command.
+
+Every fetch job is polled on its own cadence derived from the opening times
+of its canteens: often while a canteen is open, less often between the
+publication of the plans and the opening and rarely otherwise. Inactive
+canteens and canteens which are closed on the current weekday are not
+fetched at all. Canteens without known opening times, like those which were
+never fetched before, are fetched at a fixed interval.
+
+All times are local times without a timezone, like the opening times.
+"""
+import logging
+import threading
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from mensautils.canteen.fetching import FetchJob, fetch_jobs
+from mensautils.canteen.models import Canteen, OpeningTime
+from mensautils.canteen.notifications import send_notifications
+
+logger = logging.getLogger(__name__)
+
+# time between fetches while a canteen is open
+OPEN_INTERVAL = timedelta(minutes=10)
+
+# time before the opening from which on OPEN_INTERVAL is used
+OPENING_LEAD = timedelta(minutes=30)
+
+# time between fetches after the plans are published and before the opening
+PUBLICATION_INTERVAL = timedelta(minutes=30)
+
+# time after which the plans of the day are usually published
+PUBLICATION_TIME = time(6, 0)
+
+# time between fetches outside the times above
+IDLE_INTERVAL = timedelta(hours=3)
+
+# time between fetches of canteens without known opening times
+UNKNOWN_INTERVAL = timedelta(hours=1)
+
+# time to wait after a failed fetch
+RETRY_INTERVAL = timedelta(minutes=5)
+
+
+def local_now() -> datetime:
+    return timezone.localtime().replace(tzinfo=None)
+
+
+def _has_opening_times(canteen: Canteen) -> bool:
+    return any(OpeningTime.get_opening_time(canteen, weekday) is not None
+               for weekday in range(1, 8))
+
+
+def should_fetch(canteen: Optional[Canteen], now: datetime) -> bool:
+    """Check whether a canteen may be fetched on the day of now.
+
+    canteen is None for canteens which were not stored yet.
+    """
+    if canteen is None:
+        return True
+    if not canteen.active:
+        return False
+    return (OpeningTime.get_opening_time(canteen, now.isoweekday()) is not None
+            or not _has_opening_times(canteen))
+
+
+def next_fetch(canteen: Optional[Canteen], now: datetime) -> datetime:
+    """Get the time at which a canteen should be fetched after now.
+
+    For canteens which must not be fetched today, this is the time at which
+    should_fetch() has to be checked again.
+    """
+    publication = datetime.combine(now.date(), PUBLICATION_TIME)
+    tomorrow = publication + timedelta(days=1)
+    if canteen is not None and not canteen.active:
+        return tomorrow
+
+    opening_time = None
+    if canteen is not None:
+        opening_time = OpeningTime.get_opening_time(canteen, now.isoweekday())
+    if opening_time is None:
+        if canteen is not None and _has_opening_times(canteen):
+            # closed on this weekday
+            return tomorrow
+        return now + UNKNOWN_INTERVAL
+
+    opening = datetime.combine(now.date(), opening_time.start) - OPENING_LEAD
+    closing = datetime.combine(now.date(), opening_time.end)
+    if now < publication:
+        return min(now + IDLE_INTERVAL, publication)
+    if now < opening:
+        return min(now + PUBLICATION_INTERVAL, opening)
+    if now < closing:
+        return now + OPEN_INTERVAL
+    return min(now + IDLE_INTERVAL, tomorrow)
+
+
+class Scheduler:
+    """Run fetch jobs whenever they are due."""
+    def __init__(self, jobs: List[FetchJob], workers: int = 1):
+        self.jobs = jobs
+        self.workers = workers
+        now = local_now()
+        self.next_runs = {job: now for job in jobs}  # type: Dict[FetchJob, datetime]
+
+    def _get_canteens(self) -> Dict[str, Canteen]:
+        return {canteen.name: canteen for canteen in Canteen.objects.all()}
+
+    def run_due(self, now: datetime):
+        """Run the jobs due at now and schedule their next runs."""
+        due = [job for job, next_run in self.next_runs.items() if next_run <= now]
+        if not due:
+            return
+
+        canteens = self._get_canteens()
+        to_fetch = [job for job in due
+                    if any(should_fetch(canteens.get(canteen_name), now)
+                           for canteen_name, _ in job.canteens)]
+        failed = set()
+
+        def on_error(job: FetchJob, error: Exception):
+            logger.error('Fetching %s failed', job.label, exc_info=error)
+            failed.add(job)
+
+        if to_fetch:
+            logger.info('Fetching %s', ', '.join(job.label for job in to_fetch))
+            fetch_jobs(to_fetch, self.workers, on_error=on_error)
+            send_notifications()
+            # the fetch may have created canteens and changed opening times
+            canteens = self._get_canteens()
+
+        now = local_now()
+        for job in due:
+            if job in failed:
+                self.next_runs[job] = now + RETRY_INTERVAL
+                continue
+            self.next_runs[job] = min(
+                next_fetch(canteens.get(canteen_name), now)
+                for canteen_name, _ in job.canteens)
+            logger.debug('Next run of %s at %s', job.label, self.next_runs[job])
+
+    def run(self, stop: threading.Event):
+        """Run the jobs until stop is set."""
+        while not stop.is_set():
+            close_old_connections()
+            try:
+                self.run_due(local_now())
+            except Exception:
+                # storing or notifying failed, the jobs are retried later
+                logger.exception('Fetch run failed')
+                retry = local_now() + RETRY_INTERVAL
+                for job, next_run in self.next_runs.items():
+                    self.next_runs[job] = max(next_run, retry)
+            close_old_connections()
+
+            wait = min(self.next_runs.values()) - local_now()
+            stop.wait(max(wait.total_seconds(), 1))
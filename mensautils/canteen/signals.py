@@ -0,0 +1,101 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from mensautils.canteen.caching import bump_canteen_version, bump_data_version
+from mensautils.canteen.matching import dish_matcher
+from mensautils.canteen.models import Canteen, Dish, InofficialDeprecation, \
+    OpeningTime, Rating, Serving, ServingVerification
+from mensautils.canteen.statistics import count_rating, count_servings, \
+    rebuild_dish_statistics
+
+
+@receiver(post_save, sender=Dish)
+def add_dish_to_matcher(sender, instance: Dish, **kwargs):
+    dish_matcher.add(instance.pk, instance.name, instance.vegetarian,
+                     instance.vegan)
+
+
+@receiver(post_delete, sender=Dish)
+def remove_dish_from_matcher(sender, instance: Dish, **kwargs):
+    dish_matcher.discard(instance.pk)
+
+
+@receiver(post_save, sender=Serving)
+def add_serving_to_statistics(sender, instance: Serving, created: bool, **kwargs):
+    if created:
+        count_servings({instance.dish_id: 1})
+
+
+@receiver(post_delete, sender=Serving)
+def remove_serving_from_statistics(sender, instance: Serving, **kwargs):
+    count_servings({instance.dish_id: -1}, create=False)
+
+
+@receiver(post_save, sender=Rating)
+def add_rating(sender, instance: Rating, created: bool, **kwargs):
+    servings = Serving.objects.filter(pk=instance.serving_id)
+    if created:
+        servings.update(rating_sum=F('rating_sum') + instance.rating,
+                        rating_count=F('rating_count') + 1)
+        count_rating(servings.values_list('dish_id', flat=True).get(), instance.rating)
+    else:
+        # the previous rating is unknown
+        Serving.rebuild_counters(servings)
+        rebuild_dish_statistics(servings.values_list('dish_id', flat=True))
+
+
+@receiver(post_delete, sender=Rating)
+def remove_rating(sender, instance: Rating, **kwargs):
+    servings = Serving.objects.filter(pk=instance.serving_id)
+    servings.update(rating_sum=F('rating_sum') - instance.rating,
+                    rating_count=F('rating_count') - 1)
+    dish_pk = servings.values_list('dish_id', flat=True).first()
+    if dish_pk is not None:
+        count_rating(dish_pk, instance.rating, count=-1)
+
+
+@receiver(post_save, sender=ServingVerification)
+def count_verification(sender, instance: ServingVerification, created: bool, **kwargs):
+    if created:
+        Serving.objects.filter(pk=instance.serving_id).update(
+            verifications_count=F('verifications_count') + 1)
+
+
+@receiver(post_delete, sender=ServingVerification)
+def uncount_verification(sender, instance: ServingVerification, **kwargs):
+    Serving.objects.filter(pk=instance.serving_id).update(
+        verifications_count=F('verifications_count') - 1)
+
+
+@receiver(post_save, sender=InofficialDeprecation)
+def count_deprecation_report(sender, instance: InofficialDeprecation, created: bool, **kwargs):
+    if created:
+        Serving.objects.filter(pk=instance.serving_id).update(
+            deprecation_reports_count=F('deprecation_reports_count') + 1)
+
+
+@receiver(post_delete, sender=InofficialDeprecation)
+def uncount_deprecation_report(sender, instance: InofficialDeprecation, **kwargs):
+    Serving.objects.filter(pk=instance.serving_id).update(
+        deprecation_reports_count=F('deprecation_reports_count') - 1)
+
+
+def invalidate_caches(sender, **kwargs):
+    bump_data_version()
+
+
+def invalidate_canteen_caches(sender, **kwargs):
+    bump_canteen_version()
+
+
+# models shown on the cached pages
+for model in (Canteen, OpeningTime, Dish, Serving, Rating, ServingVerification,
+              InofficialDeprecation):
+    post_save.connect(invalidate_caches, sender=model)
+    post_delete.connect(invalidate_caches, sender=model)
+
+# models shown in the cached canteen list
+for model in (Canteen, OpeningTime):
+    post_save.connect(invalidate_canteen_caches, sender=model)
+    post_delete.connect(invalidate_canteen_caches, sender=model)
@@ -0,0 +1,27 @@
+"""Directories of saved source pages.
+
+The pages of every source are stored in a subdirectory named after the
+source. This layout is used by the benchmark corpus and the pages imported
+by the backfill command. The file names have to sort in the order the pages
+were saved.
+"""
+import os
+from typing import List, Tuple
+
+# sources of saved pages, which are stored in subdirectories of the same name
+STWHH = 'stwhh'
+DESY = 'desy'
+SOURCES = (STWHH, DESY)
+
+
+def find_snapshots(directory: str) -> List[Tuple[str, str]]:
+    """Get the source and path of every saved page in directory."""
+    snapshots = []
+    for source in SOURCES:
+        source_directory = os.path.join(directory, source)
+        if not os.path.isdir(source_directory):
+            continue
+        for file_name in sorted(os.listdir(source_directory)):
+            if file_name.endswith('.html'):
+                snapshots.append((source, os.path.join(source_directory, file_name)))
+    return snapshots
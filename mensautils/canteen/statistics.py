@@ -1,19 +1,76 @@
-from django.db.models import Count, Avg
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
 
-from mensautils.canteen.models import Dish
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Sum
+from django.db.models.functions import Cast, Coalesce
+
+from mensautils.canteen.models import Dish, DishStatistics
 
 
 def get_most_frequent_dishes():
-    dishes = Dish.objects.annotate(
-        servings__count=Count('servings')).order_by(
-        '-servings__count')[:10]
-    return dishes
+    statistics = DishStatistics.objects.select_related('dish').order_by(
+        '-serving_count')[:10]
+    return statistics
 
 
 def get_most_favored_dishes():
-    dishes = Dish.objects.annotate(
-        servings__ratings__rating__count=Count('servings__ratings__rating'),
-        servings__ratings__rating__avg=Avg('servings__ratings__rating')).filter(
-        servings__ratings__rating__avg__isnull=False).order_by(
-        '-servings__ratings__rating__avg')[:10]
-    return dishes
+    statistics = DishStatistics.objects.select_related('dish').filter(
+        rating_count__gt=0).annotate(
+        rating_avg=ExpressionWrapper(
+            Cast('rating_sum', FloatField()) / F('rating_count'),
+            output_field=FloatField())).order_by(
+        '-rating_avg')[:10]
+    return statistics
+
+
+def count_servings(dish_counts: Dict[int, int], create: bool = True):
+    """Add numbers of servings (negative when deleted) to the statistics of dishes.
+
+    Missing statistics are only created if create is set, which must not be
+    done when deleting, as the dish may be deleted as well.
+    """
+    if create:
+        DishStatistics.objects.bulk_create(
+            [DishStatistics(dish_id=dish_pk) for dish_pk in dish_counts],
+            ignore_conflicts=True)
+    by_count = defaultdict(list)
+    for dish_pk, count in dish_counts.items():
+        by_count[count].append(dish_pk)
+    for count, dish_pks in by_count.items():
+        DishStatistics.objects.filter(dish_id__in=dish_pks).update(
+            serving_count=F('serving_count') + count)
+
+
+def count_rating(dish_pk: int, rating: int, count: int = 1):
+    """Add a rating (count=-1 when deleted) to the statistics of a dish.
+
+    Missing statistics are only created when adding a rating, like in
+    count_servings().
+    """
+    if count > 0:
+        DishStatistics.objects.get_or_create(dish_id=dish_pk)
+    DishStatistics.objects.filter(dish_id=dish_pk).update(
+        rating_count=F('rating_count') + count,
+        rating_sum=F('rating_sum') + count * rating)
+
+
+def rebuild_dish_statistics(dish_pks: Optional[Iterable[int]] = None):
+    """Recompute the statistics of dishes from their servings."""
+    dishes = Dish.objects.all()
+    statistics = DishStatistics.objects.all()
+    if dish_pks is not None:
+        dishes = dishes.filter(pk__in=dish_pks)
+        statistics = statistics.filter(dish_id__in=dish_pks)
+
+    totals = dishes.annotate(
+        serving_count=Count('servings'),
+        rating_count=Coalesce(Sum('servings__rating_count'), 0),
+        rating_sum=Coalesce(Sum('servings__rating_sum'), 0)).values_list(
+        'pk', 'serving_count', 'rating_count', 'rating_sum')
+    with transaction.atomic():
+        statistics.delete()
+        DishStatistics.objects.bulk_create([
+            DishStatistics(dish_id=dish_pk, serving_count=serving_count,
+                           rating_count=rating_count, rating_sum=rating_sum)
+            for dish_pk, serving_count, rating_count, rating_sum in totals])
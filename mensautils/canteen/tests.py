@@ -1,3 +1,647 @@
-from django.test import TestCase
+import gzip
+import os
+import random
+import re
+from contextlib import nullcontext
+from io import StringIO
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Max, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+    modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from fuzzywuzzy import fuzz
+
+from mensautils.canteen import performance
+from mensautils.canteen.archive import backfill_servings, store_canteen_data
+from mensautils.canteen.dedupe import find_duplicates, merge_duplicates
+from mensautils.canteen.management.benchmark import CORPUS, load_corpus
+from mensautils.canteen.matching import DishMatcher
+from mensautils.canteen.models import Canteen, Dish, DishStatistics, \
+    InofficialDeprecation, Notification, OpeningTime, OutgoingMail, QueuedServing, \
+    Rating, Serving, ServingVerification
+from mensautils.canteen.notifications import queue_notifications, send_notifications
+from mensautils.canteen.outbox import _claim_pending, queue_mail, send_outbox
+from mensautils.canteen.scheduling import next_fetch, should_fetch
+from mensautils.canteen.snapshots import DESY, STWHH
+from mensautils.canteen.statistics import rebuild_dish_statistics
+from mensautils.canteen.views import _render_plan
+from mensautils.parser import canteen_result, desy, studierendenwerk
+from mensautils.parser.canteen_result import CanteenResult
+
+# tables which grow with the history and must never be scanned completely
+HISTORY_TABLES = ('canteen_serving', 'canteen_rating')
+
+# week plan of the DESY canteen with one day
+DESY_PLAN = '''
+<div id="openings"><p>Kantine<br>Mo - Fr 11.00 - 14.00</p></div>
+<div class="entry" id="entry-{day}">
+  <table class="entry"><tr><td>Currywurst mit Pommes<br>Curry sausage with fries</td>
+    <td>€ 4,50</td></tr></table>
+  <table class="entry"><tr><td>Gemüselasagne<br>Vegetable lasagna</td>
+    <td>€ 3,90</td></tr></table>
+</div>
+'''
+
+# tests must neither use nor change the caches of a running instance
+test_settings = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+
+
+@test_settings
+class HistoryTestCase(TestCase):
+    """Test case with some weeks of servings of three canteens."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.today = date.today()
+        cls.user = User.objects.create_user('user', 'user@example.com')
+        canteens = [Canteen.objects.create(name='Canteen {}'.format(i))
+                    for i in range(3)]
+        dishes = [Dish.objects.create(name='Dish {}'.format(i), vegetarian=False,
+                                      vegan=False)
+                  for i in range(10)]
+
+        servings = []
+        for days in range(-60, 2):
+            for canteen in canteens:
+                for dish in dishes[:5]:
+                    servings.append(Serving(
+                        date=cls.today + timedelta(days=days), canteen=canteen,
+                        dish=dish, price=Decimal('2.50'),
+                        price_staff=Decimal('3.50'), notified=days < 0))
+        Serving.objects.bulk_create(servings)
+        Rating.objects.bulk_create([
+            Rating(user=cls.user, serving=serving, rating=3)
+            for serving in Serving.objects.filter(date__lt=cls.today)[::7]])
+        # bulk_create does not send the signals maintaining the counters
+        Serving.rebuild_counters()
+        rebuild_dish_statistics()
+        cls.canteen = canteens[0]
+        Notification.objects.create(user=cls.user, pattern='Dish 3')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked with SQLite')
+class QueryPlanTest(HistoryTestCase):
+    """Check that the hot queries use indexes instead of full table scans."""
+
+    def assertIndexed(self, queries):
+        for query in queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+            for table in HISTORY_TABLES:
+                # SQLite reports a search without index for MIN/MAX as well
+                full_scan = re.compile(
+                    r'\b(SCAN (TABLE )?{0}\b|SEARCH (TABLE )?{0}\b(?! USING))'.format(table))
+                self.assertIsNone(
+                    full_scan.search(plan),
+                    'full scan of {}:\n{}\n{}'.format(table, query['sql'], plan))
+
+    def test_index_plan(self):
+        with CaptureQueriesContext(connection) as queries:
+            _render_plan(self.today)
+        self.assertIndexed(queries)
+
+    def test_last_updated(self):
+        with CaptureQueriesContext(connection) as queries:
+            Serving.objects.aggregate(Max('last_updated'))
+        self.assertIndexed(queries)
+
+    def test_api_servings(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/api/canteens/{}/today/'.format(self.canteen.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertIndexed(queries)
+
+    def test_api_servings_range(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/servings/', {
+                'canteen': [self.canteen.pk], 'start': self.today - timedelta(days=7),
+                'end': self.today})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 8 * 5)
+        self.assertIndexed(queries)
+
+    def test_export(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/export/servings/', {
+                'canteen': [self.canteen.pk], 'start': self.today - timedelta(days=7)})
+            b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        self.assertIndexed(queries)
+
+    def test_dish_search(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/dishes/search/', {
+                'q': 'dis 3', 'canteen': [self.canteen.pk],
+                'start': self.today - timedelta(days=2), 'end': self.today})
+        self.assertEqual(response.status_code, 200)
+        self.assertIndexed(queries)
+
+    def test_daily_rating_limit(self):
+        with CaptureQueriesContext(connection) as queries:
+            Rating.objects.filter(user=self.user, serving__date=self.today).count()
+        self.assertIndexed(queries)
+
+    def test_notifications(self):
+        queue_notifications(Serving.objects.filter(
+            date__gte=self.today).values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            send_notifications()
+        self.assertIndexed(queries)
+
+    def test_dish_key(self):
+        with CaptureQueriesContext(connection) as queries:
+            Dish.fuzzy_find_or_create_pks([('dish 3', False, False)])
+        self.assertIndexed(queries)
+
+    def test_archive(self):
+        result = CanteenResult({}, [
+            canteen_result.Serving(self.today, 'Dish {}'.format(i),
+                                   Decimal('2.50'), Decimal('3.50'),
+                                   False, False, set())
+            for i in range(5)])
+        with CaptureQueriesContext(connection) as queries:
+            store_canteen_data(self.canteen.name, result)
+        self.assertIndexed(queries)
+
+
+@test_settings
+class ArchiveTest(TestCase):
+    def test_store_desy_twice(self):
+        for _ in range(2):
+            store_canteen_data('DESY', desy.parse_plan(DESY_PLAN.format(day=date.today())))
+        self.assertEqual(
+            sorted(Serving.objects.values_list('dish__name', 'officially_deprecated')),
+            [('Currywurst mit Pommes / Curry sausage with fries', False),
+             ('Gemüselasagne / Vegetable lasagna', False)])
+
+    def test_queue_desy_servings(self):
+        store_canteen_data('DESY', desy.parse_plan(DESY_PLAN.format(day=date.today())))
+        self.assertEqual(
+            sorted(QueuedServing.objects.values_list('serving_id', flat=True)),
+            sorted(Serving.objects.values_list('pk', flat=True)))
+        self.assertEqual(QueuedServing.objects.count(), 2)
+
+
+class ParserBackendTest(SimpleTestCase):
+    canteen_numbers = [174, 170, 162]
+
+    def parse(self, backend, strained):
+        """Parse the recorded pages with a backend, with or without the
+        strainers."""
+        corpus = load_corpus(CORPUS)
+        with mock.patch('mensautils.parser.soup.BACKEND', backend), \
+                mock.patch.multiple(
+                    studierendenwerk,
+                    SECTIONS=studierendenwerk.SECTIONS if strained else None,
+                    LOCATIONS=studierendenwerk.LOCATIONS if strained else None), \
+                mock.patch.object(desy, 'PLAN_PARTS', desy.PLAN_PARTS if strained else None):
+            results = [CanteenResult(
+                studierendenwerk.parse_opening_times(page, self.canteen_numbers)[number],
+                servings)
+                for page in corpus[STWHH]
+                for number, servings in studierendenwerk.parse_day_plan(
+                    page, self.canteen_numbers).items()]
+            results += [desy.parse_plan(page) for page in corpus[DESY]]
+        return [(result.opening_times, [
+            (serving.day, serving.title, serving.price, serving.price_staff,
+             serving.vegetarian, serving.vegan, serving.allergens)
+            for serving in result.servings]) for result in results]
+
+    def test_backends_and_strainers(self):
+        expected = self.parse('html.parser', strained=False)
+        self.assertEqual(sum(len(servings) for _, servings in expected), 23)
+        for backend in ('html.parser', 'lxml'):
+            for strained in (False, True):
+                with self.subTest(backend=backend, strained=strained):
+                    self.assertEqual(self.parse(backend, strained), expected)
+
+
+class BackfillTest(HistoryTestCase):
+    def test_backfill_servings(self):
+        day = self.today - timedelta(days=100)
+        servings = {
+            canteen_name: [canteen_result.Serving(
+                day + timedelta(days=days), name, Decimal('2.50'), Decimal('3.50'),
+                False, False, set()) for days in range(2) for name in ('Dish 3', 'Dish 8')]
+            for canteen_name in (self.canteen.name, 'New canteen')}
+        self.assertEqual(backfill_servings(servings), 8)
+        created = Serving.objects.filter(date__lt=self.today - timedelta(days=60))
+        self.assertEqual(created.count(), 8)
+        # no notifications for history
+        self.assertFalse(created.filter(notified=False).exists())
+        self.assertFalse(QueuedServing.objects.exists())
+        self.assertEqual(DishStatistics.objects.get(dish__name='Dish 8').serving_count, 4)
+
+        # stored servings are left untouched
+        self.assertEqual(backfill_servings(servings), 0)
+        self.assertEqual(created.count(), 8)
+        self.assertFalse(Serving.objects.filter(officially_deprecated=True).exists())
+
+
+class CounterTest(HistoryTestCase):
+    def counters(self, serving):
+        serving.refresh_from_db()
+        return (serving.rating_sum, serving.rating_count, serving.verifications_count,
+                serving.deprecation_reports_count)
+
+    def test_create_and_delete(self):
+        other_user = User.objects.create_user('other', 'other@example.com')
+        serving = Serving.objects.filter(date=self.today + timedelta(days=1)).first()
+        self.assertEqual(self.counters(serving), (0, 0, 0, 0))
+
+        ratings = [Rating.objects.create(user=user, serving=serving, rating=rating)
+                   for user, rating in ((self.user, 4), (other_user, 1))]
+        verifications = [ServingVerification.objects.create(serving=serving, user=user)
+                         for user in (self.user, other_user)]
+        report = InofficialDeprecation.objects.create(serving=serving, reporter=self.user)
+        self.assertEqual(self.counters(serving), (5, 2, 2, 1))
+
+        ratings[0].delete()
+        verifications[1].delete()
+        report.delete()
+        self.assertEqual(self.counters(serving), (1, 1, 1, 0))
+
+        # deleting the user deletes the remaining rating and verification
+        other_user.delete()
+        self.assertEqual(self.counters(serving), (0, 0, 1, 0))
+
+    def test_rebuild_drifted_counters(self):
+        serving = Serving.objects.filter(date=self.today + timedelta(days=1)).first()
+        ServingVerification.objects.create(serving=serving, user=self.user)
+        InofficialDeprecation.objects.create(serving=serving, reporter=self.user)
+        expected = sorted(Serving.objects.values_list(
+            'pk', 'rating_sum', 'rating_count', 'verifications_count',
+            'deprecation_reports_count'))
+
+        Serving.objects.update(rating_sum=7, rating_count=0, verifications_count=3,
+                               deprecation_reports_count=-1)
+        call_command('rebuildcounters')
+        self.assertEqual(sorted(Serving.objects.values_list(
+            'pk', 'rating_sum', 'rating_count', 'verifications_count',
+            'deprecation_reports_count')), expected)
+        # the maintained counters matched the ratings in the first place
+        self.assertEqual(
+            Serving.objects.aggregate(Sum('rating_sum'), Sum('rating_count')),
+            {'rating_sum__sum': Rating.objects.aggregate(Sum('rating'))['rating__sum'],
+             'rating_count__sum': Rating.objects.count()})
+        self.assertEqual(self.counters(serving)[2:], (1, 1))
+
+
+class StatisticsTest(HistoryTestCase):
+    def test_delete_serving(self):
+        serving = Serving.objects.filter(dish__name='Dish 0', ratings__isnull=False)[0]
+        serving.delete()
+        statistics = DishStatistics.objects.get(dish__name='Dish 0')
+        self.assertEqual(statistics.serving_count, 3 * 62 - 1)
+        self.assertEqual(statistics.rating_count, Rating.objects.filter(
+            serving__dish__name='Dish 0').count())
+
+    def test_delete_rated_dish(self):
+        dish = Dish.objects.get(name='Dish 0')
+        self.assertTrue(Rating.objects.filter(serving__dish=dish).exists())
+        dish.delete()
+        self.assertFalse(DishStatistics.objects.filter(dish_id=dish.pk).exists())
+
+
+class NotificationTest(HistoryTestCase):
+    def test_send_notifications(self):
+        queue_notifications(Serving.objects.filter(
+            date__gte=self.today).values_list('pk', flat=True))
+        send_notifications()
+        # one mail per notification, servings of tomorrow stay queued
+        self.assertEqual(OutgoingMail.objects.count(), 1)
+        self.assertEqual(QueuedServing.objects.count(), 3 * 5)
+        self.assertFalse(QueuedServing.objects.filter(serving__date=self.today).exists())
+
+
+@test_settings
+class OutboxTest(TransactionTestCase):
+    """The mails are stored by the sending threads, which cannot see the
+    transaction of a TestCase.
+    """
+    def setUp(self):
+        for i in range(3):
+            queue_mail('Subject', 'Message', 'from@example.com',
+                       'user{}@example.com'.format(i)).save()
+
+    def test_one_connection_per_batch(self):
+        connection = mock.Mock()
+        with mock.patch('mensautils.canteen.outbox.get_connection',
+                        return_value=connection):
+            self.assertEqual(send_outbox(workers=1, batch_size=10), (3, 0))
+        self.assertEqual(connection.send_messages.call_count, 3)
+        # opened before every message, which does nothing if it is open
+        self.assertEqual(connection.open.call_count, 3)
+        connection.close.assert_called_once_with()
+
+    def test_claimed_mails_skipped(self):
+        # mails claimed by an overlapping run
+        claimed = _claim_pending(timezone.now())
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(send_outbox(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+        # until the claim expires
+        OutgoingMail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_outbox(), (3, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(send_outbox(), (0, 0))
+
+    def test_failed_mail(self):
+        first, second, third = OutgoingMail.objects.order_by('pk')
+
+        def send_messages(messages):
+            if messages[0].to == [second.recipient]:
+                # the mails sent before are stored already
+                self.assertTrue(OutgoingMail.objects.filter(
+                    pk=first.pk, sent__isnull=False).exists())
+                raise OSError('connection lost')
+
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        with mock.patch('mensautils.canteen.outbox.get_connection',
+                        return_value=connection):
+            self.assertEqual(send_outbox(workers=1, batch_size=10), (2, 1))
+        second.refresh_from_db()
+        self.assertIsNone(second.sent)
+        self.assertEqual((second.attempts, second.last_error),
+                         (1, 'OSError: connection lost'))
+        self.assertEqual(OutgoingMail.objects.filter(sent__isnull=False).count(), 2)
+
+
+@test_settings
+@modify_settings(MIDDLEWARE={'prepend': 'mensautils.canteen.performance.PerformanceMiddleware'})
+class PerformanceTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', is_staff=True)
+
+    def test_server_timing(self):
+        response = self.client.get('/api/canteens/')
+        self.assertEqual(
+            [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')],
+            ['db', 'template', 'view', 'total'])
+
+    def test_report(self):
+        cache.clear()
+        self.client.get('/api/canteens/')
+        # measurements published by another worker
+        cache.set(performance.WORKERS_KEY, ['other:1'])
+        cache.set(performance.SAMPLES_KEY.format('other:1'), {
+            'mensautils.canteen:canteens-list': [(10.0, 0.5, 0.0, 1)] * 2})
+
+        # staff only
+        self.assertEqual(self.client.get('/performance/').status_code, 302)
+        self.client.force_login(self.staff)
+        report = self.client.get('/performance/').json()
+        self.assertEqual(report['workers'], 2)
+        canteen_list = report['views']['mensautils.canteen:canteens-list']
+        self.assertGreaterEqual(canteen_list['requests'], 3)
+        self.assertEqual(canteen_list['total_ms']['p99'], 10000)
+
+
+@test_settings
+class FetchScheduleTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.canteen = Canteen.objects.create(name='Canteen')
+        OpeningTime.objects.create(canteen=cls.canteen, weekday=1,
+                                   start=time(11), end=time(14))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_open(self):
+        monday = datetime(2024, 1, 1, 12)
+        with self.assertNumQueries(1):
+            self.assertTrue(should_fetch(self.canteen, monday))
+            self.assertEqual(next_fetch(self.canteen, monday),
+                             monday + timedelta(minutes=10))
+
+    def test_closed(self):
+        tuesday = datetime(2024, 1, 2, 12)
+        self.assertFalse(should_fetch(self.canteen, tuesday))
+        self.assertEqual(next_fetch(self.canteen, tuesday), datetime(2024, 1, 3, 6))
+
+
+@test_settings
+class ApiCachingTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        store_canteen_data('DESY', desy.parse_plan(DESY_PLAN.format(day=date.today())))
+        self.params = {'canteen': [Canteen.objects.get().pk],
+                       'start': date.today(), 'end': date.today()}
+
+    def test_not_modified(self):
+        response = self.client.get('/api/servings/', self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+        response = self.client.get('/api/servings/', self.params,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_data_change(self):
+        etag = self.client.get('/api/servings/', self.params)['ETag']
+        # the data version is replaced when the new servings are committed
+        store_canteen_data('DESY', desy.parse_plan(DESY_PLAN.format(
+            day=date.today()).replace('Currywurst', 'Bratwurst')))
+
+        response = self.client.get('/api/servings/', self.params,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Bratwurst', response.content.decode())
+
+
+class ServingApiTest(HistoryTestCase):
+    def test_pages(self):
+        params = {'canteen': [self.canteen.pk], 'start': self.today - timedelta(days=1),
+                  'end': self.today, 'page_size': 3}
+        response = self.client.get('/api/servings/', params)
+        servings = response.json()['results']
+        while response.json()['next']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.json()['next'])
+            servings += response.json()['results']
+            # the page is found by the primary key, not by skipping rows
+            self.assertNotIn('OFFSET', ' '.join(query['sql'] for query in queries))
+        self.assertEqual(
+            [(serving['date'], serving['dish']) for serving in servings],
+            [(day.isoformat(), dish) for day, dish in Serving.objects.filter(
+                canteen=self.canteen, date__gte=self.today - timedelta(days=1),
+                date__lte=self.today).order_by('pk').values_list('date', 'dish__name')])
+
+
+class ExportTest(HistoryTestCase):
+    def test_export_servings(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/export/servings/', {
+            'canteen': [self.canteen.pk], 'start': self.today - timedelta(days=7),
+            'gzip': 1})
+        self.assertEqual(response.status_code, 200)
+        content = gzip.decompress(b''.join(response.streaming_content))
+        # header and the servings of the last week, today and tomorrow
+        self.assertEqual(len(content.decode().splitlines()), 1 + 9 * 5)
+
+    def test_gzip_flag(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/export/servings/', {'gzip': 'false'})
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        response = self.client.get('/export/servings/', {'gzip': 'maybe'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_login_required(self):
+        response = self.client.get('/export/servings/')
+        self.assertEqual(response.status_code, 302)
+
+
+class DedupeTest(HistoryTestCase):
+    def test_dedupe_dishes(self):
+        duplicate = Dish.objects.create(name='dish  3', vegetarian=False, vegan=False)
+        Serving.objects.filter(canteen=self.canteen, dish__name='Dish 3').update(
+            dish=duplicate)
+        clusters = find_duplicates()
+        self.assertEqual(clusters, {Dish.objects.get(name='Dish 3').pk: [duplicate.pk]})
+        self.assertEqual(merge_duplicates(clusters), (62, 0))
+        self.assertFalse(Dish.objects.filter(pk=duplicate.pk).exists())
+        self.assertEqual(DishStatistics.objects.get(dish__name='Dish 3').serving_count,
+                         3 * 62)
+
+    def test_chain(self):
+        name = 'Hähnchenbrust mit Kartoffelgratin'
+        first, second, third = [
+            Dish.objects.create(name=dish_name, vegetarian=False, vegan=False)
+            for dish_name in (name, name + ' xy', name + ' xy zw')]
+        # the third dish only reaches the threshold with the second one
+        self.assertEqual(find_duplicates(), {first.pk: [second.pk]})
+
+    def test_same_day(self):
+        duplicate = Dish.objects.create(name='dish  3', vegetarian=False, vegan=False)
+        Serving.objects.create(date=self.today, canteen=self.canteen, dish=duplicate,
+                               price=Decimal('2.50'), price_staff=Decimal('3.50'))
+        self.assertEqual(merge_duplicates(find_duplicates()), (1, 1))
+        servings = Serving.objects.filter(
+            date=self.today, canteen=self.canteen, dish__name='Dish 3').order_by('pk')
+        self.assertEqual([serving.officially_deprecated for serving in servings],
+                         [False, True])
+
+
+@test_settings
+class DishKeyTest(TestCase):
+    def test_equal_key_preferred(self):
+        Dish.objects.create(name='Currywurst mit Pommes frites', vegetarian=False,
+                            vegan=False)
+        dish = Dish.objects.create(name='Currywurst mit Pommes  frite', vegetarian=False,
+                                   vegan=False)
+        # an equal key is preferred over the older similar dish
+        with self.assertNumQueries(1):
+            pks = Dish.fuzzy_find_or_create_pks([('frite Currywurst mit Pommes', False, False)])
+        self.assertEqual(pks, [dish.pk])
+
+
+class DishMatcherTest(SimpleTestCase):
+    words = ['Currywurst', 'Pommes', 'frites', 'Gemüselasagne', 'Tomatensoße',
+             'Kartoffelpüree', 'Hähnchenbrust', 'Reis', 'Salat', 'mit', 'und',
+             'Spätzle', 'Linseneintopf', 'Brötchen', 'Falafel', 'Hummus']
+
+    def mutate(self, name, rng):
+        """Change a character of name or swap two of its tokens."""
+        if rng.random() < 0.3:
+            tokens = name.split()
+            rng.shuffle(tokens)
+            return ' '.join(tokens)
+        position = rng.randrange(len(name))
+        return name[:position] + rng.choice('aeiouäöß -') + name[position + 1:]
+
+    def test_same_as_scan(self):
+        rng = random.Random(0)
+        dishes = []
+        for pk in range(1, 301):
+            if dishes and rng.random() < 0.4:
+                name = self.mutate(rng.choice(dishes)[1], rng)
+            else:
+                name = ' '.join(rng.choice(self.words) for _ in range(rng.randint(1, 5)))
+            flags = rng.choice([(False, False), (True, False), (True, True)])
+            dishes.append((pk, name) + flags)
+        matcher = DishMatcher()
+        matcher.load(dishes)
+
+        queries = [(name, flags) for _, name, *flags in rng.sample(dishes, 30)]
+        queries += [(self.mutate(name, rng), flags) for name, flags in queries]
+        queries += [(' '.join(rng.choice(self.words) for _ in range(3)),
+                     [False, False]) for _ in range(10)]
+        for name, flags in queries:
+            ratios = {pk: fuzz.token_sort_ratio(name, dish_name)
+                      for pk, dish_name, *dish_flags in dishes if dish_flags == flags}
+            # the ratios of some dishes and the ones just above them
+            near = set(rng.sample(sorted(set(ratios.values())), 3))
+            for min_ratio in {50, 80, 90, 95, 100} | near | {r + 1 for r in near}:
+                expected = min((pk for pk, ratio in ratios.items() if ratio >= min_ratio),
+                               default=None)
+                with self.subTest(name=name, min_ratio=min_ratio):
+                    self.assertEqual(matcher.match(name, *flags, min_ratio), expected)
+
+
+class DishSearchTest(HistoryTestCase):
+    def test_search_servings(self):
+        response = self.client.get('/api/dishes/search/', {
+            'q': 'dis 3', 'canteen': [self.canteen.pk],
+            'start': self.today - timedelta(days=2), 'end': self.today})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['name'] for result in results], ['Dish 3'])
+        self.assertEqual(len(results[0]['servings']), 3)
+
+    def test_search_common_word(self):
+        Dish.objects.bulk_create([
+            Dish(name='Currywurst {}'.format(i), vegetarian=False, vegan=False)
+            for i in range(600)])
+        dish = Dish.objects.create(name='Currywurst mit Pommes', vegetarian=False,
+                                   vegan=False)
+        Serving.objects.create(date=self.today, canteen=self.canteen, dish=dish,
+                               price=Decimal('3.50'), price_staff=Decimal('4.50'))
+        response = self.client.get('/api/dishes/search/', {
+            'q': 'currywurst', 'canteen': [self.canteen.pk], 'start': self.today})
+        self.assertEqual([result['id'] for result in response.json()['results']],
+                         [dish.pk])
+
+
+@test_settings
+class BenchmarkTest(TransactionTestCase):
+    # the benchmark creates its own test databases otherwise
+    @mock.patch('mensautils.canteen.management.commands.benchmark.'
+                'benchmark_environment', nullcontext)
+    def test_recorded_corpus(self):
+        out = StringIO()
+        # only the query counts are compared, timings vary too much
+        call_command('benchmark', fixtures=CORPUS, repeat=1, history_days=7,
+                     baseline=os.path.join(CORPUS, 'baseline.json'),
+                     tolerance=1000, stdout=out)
+        stages = [line.split()[0] for line in out.getvalue().splitlines()[1:]]
+        self.assertEqual(stages, [
+            'parse_day_plan', 'parse_opening_times', 'parse_full_plan',
+            'store_canteen_data', 'store_canteen_data_unchanged',
+            'send_notifications'])
+        # the recorded dishes have been archived
+        self.assertTrue(Serving.objects.filter(
+            canteen__name='Benchmark 174', dish__name__startswith='Currywurst').exists())
+        self.assertTrue(Serving.objects.filter(
+            canteen__name='Benchmark DESY 0', dish__name__startswith='Gemüsecurry').exists())
@@ -1,7 +1,7 @@
 from django.conf.urls import url
 from rest_framework.routers import DefaultRouter
 
-from mensautils.canteen import views
+from mensautils.canteen import performance, views
 
 app_name = 'mensautils.canteen'
 urlpatterns = [
@@ -17,8 +17,12 @@ urlpatterns = [
     url(r'^notification/(\d+)/delete/$', views.delete_notification,
         name='delete_notification'),
     url(r'^notification/add/$', views.add_notification, name='add_notification'),
+    url(r'^export/(servings|ratings)/$', views.export_history, name='export'),
+    url(r'^performance/$', performance.performance_report, name='performance'),
 ]
 
 router = DefaultRouter()
 router.register(r'api/canteens', views.CanteenViewSet, basename='canteens')
+router.register(r'api/servings', views.ServingViewSet, basename='servings')
+router.register(r'api/dishes/search', views.DishSearchViewSet, basename='dish-search')
 urlpatterns += router.urls
@@ -1,44 +1,69 @@
+import hashlib
 import re
 from collections import OrderedDict
 from datetime import date, timedelta
+from typing import List, Optional
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Max, Avg, Count
+from django.core.cache import cache
+from django.db.models import Max
 from django.http import HttpRequest
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseNotFound
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.urls import reverse
-from django.views.decorators.http import require_POST
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
+from django.views.decorators.vary import vary_on_headers
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 
+from mensautils.canteen import export
+from mensautils.canteen.caching import get_canteen_version, get_data_version
 from mensautils.canteen.forms import RateForm, SubmitServingForm, NotificationForm
+from mensautils.canteen.matching import dish_matcher
 from mensautils.canteen.models import Canteen, Serving, Rating, InofficialDeprecation, \
     Dish, ServingVerification, Notification, CanteenUserConfig
+from mensautils.canteen.notifications import queue_notifications
 from mensautils.canteen.serializers import CanteenSerializer, ServingSerializer
 from mensautils.canteen.statistics import get_most_frequent_dishes, \
     get_most_favored_dishes
 
 
+# seconds the rendered plan of a data version is cached
+PLAN_CACHE_TIMEOUT = 24 * 60 * 60
+
+# seconds the serialized canteen list of a canteen version is cached
+CANTEEN_LIST_CACHE_TIMEOUT = 24 * 60 * 60
+
+# seconds clients may use API responses before revalidating them
+API_MAX_AGE = 60
+
+# minimum ratio of the words of the dish search matching with typos
+SEARCH_MIN_RATIO = 90
+
+# number of dishes returned by the dish search
+SEARCH_DEFAULT_RESULTS = 20
+SEARCH_MAX_RESULTS = 100
+
+
 def index(request: HttpRequest) -> HttpResponse:
     today = date.today()
-    first_day = _get_valid_day(today)
-    next_day = _get_valid_day(first_day + timedelta(days=1))
-    servings = (Serving.objects.filter(date=first_day) |
-                Serving.objects.filter(date=next_day))
-    servings = servings.select_related(
-        'dish', 'canteen').annotate(
-        ratings__rating__avg=Avg('ratings__rating'),
-        ratings__count=Count('ratings', distinct=True),
-        verifications__count=Count('verifications', distinct=True),
-        deprecation_reports__count=Count('deprecation_reports', distinct=True)
-    ).order_by(
-        'date', 'canteen__name', 'officially_deprecated',
-        'deprecation_reports__count', 'dish__name')
+    plan_key = 'mensautils:plan:{}:{}'.format(get_data_version(), today)
+    plan = cache.get(plan_key)
+    if plan is None:
+        plan = _render_plan(today)
+        cache.set(plan_key, plan, PLAN_CACHE_TIMEOUT)
 
     user_config = '', ''
     user_config_available = False
@@ -49,6 +74,25 @@ def index(request: HttpRequest) -> HttpResponse:
             user_config = config.order, config.hidden
             user_config_available = True
 
+    return render(request, 'mensautils/mensa.html', {
+        'plan': plan['html'],
+        'user_config': user_config,
+        'user_config_available': user_config_available,
+        'last_updated': plan['last_updated'],
+    })
+
+
+def _render_plan(today: date) -> dict:
+    """Render the plan shown on the index page, which is the same for all users."""
+    first_day = _get_valid_day(today)
+    next_day = _get_valid_day(first_day + timedelta(days=1))
+    servings = (Serving.objects.filter(date=first_day) |
+                Serving.objects.filter(date=next_day))
+    servings = servings.select_related(
+        'dish', 'canteen').order_by(
+        'date', 'canteen__name', 'officially_deprecated',
+        'deprecation_reports_count', 'dish__name')
+
     canteen_data = OrderedDict()
     canteen_data[first_day] = OrderedDict()
     canteen_data[next_day] = OrderedDict()
@@ -65,16 +109,15 @@ def index(request: HttpRequest) -> HttpResponse:
             canteen_data[serving.date][serving.canteen] = []
 
         canteen_data[serving.date][serving.canteen].append(serving)
-    return render(request, 'mensautils/mensa.html', {
-        'days': (first_day, next_day),
-        'today': today,
-        'first_day': first_day,
-        'mensa_data': canteen_data,
-        'user_config': user_config,
-        'user_config_available': user_config_available,
+    return {
+        'html': render_to_string('mensautils/mensa_plan.html', {
+            'today': today,
+            'first_day': first_day,
+            'mensa_data': canteen_data,
+        }),
         'last_updated': Serving.objects.aggregate(
             Max('last_updated'))['last_updated__max'],
-    })
+    }
 
 
 @login_required
@@ -178,6 +221,7 @@ def submit_serving(request: HttpRequest, canteen_pk: int) -> HttpResponse:
                 price_staff=price_staff, official=False)
             ServingVerification.objects.create(
                 user=request.user, reporter=True, serving=serving)
+            queue_notifications([serving.pk])
             messages.success(
                 request, 'Das Gericht wurde erfolgreich gespeichert.')
             return redirect(reverse('mensautils.canteen:index'))
@@ -299,6 +343,33 @@ def delete_notification(request: HttpRequest, notification_pk: int) -> HttpRespo
         })
 
 
+@login_required
+def export_history(request: HttpRequest, kind: str) -> HttpResponse:
+    """Stream all servings or ratings as CSV or NDJSON.
+
+    The rows can be filtered by the start, end and canteen parameters like
+    the servings API. Setting gzip to 1 or true compresses the output.
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        return HttpResponseBadRequest('Unknown format.')
+    try:
+        filters = export.parse_filters(
+            request.GET.get('start'), request.GET.get('end'),
+            request.GET.getlist('canteen'))
+        compress = export.parse_flag(request.GET.get('gzip'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(
+        export.iter_export(kind, export_format, filters, compress),
+        content_type='application/gzip' if compress else '{}; charset=utf-8'.format(
+            export.FORMATS[export_format][0]))
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        export.get_file_name(kind, export_format, compress))
+    return response
+
+
 def _get_valid_day(base_day: date) -> date:
     """Get the next valid day (i.e. skip sunday)"""
     if base_day.weekday() == 6:
@@ -306,9 +377,38 @@ def _get_valid_day(base_day: date) -> date:
     return base_day
 
 
+def _api_etag(request: HttpRequest, *args, **kwargs) -> str:
+    """Get the validator of an API response without querying the data.
+
+    The date is part of it, as the servings of today and tomorrow change
+    at midnight without a new data version.
+    """
+    return hashlib.md5('{}:{}:{}:{}'.format(
+        get_data_version(), date.today(), request.get_full_path(),
+        request.META.get('HTTP_ACCEPT', '')).encode()).hexdigest()
+
+
+# conditional requests and client side caching for all API views
+API_CACHING = [
+    cache_control(max_age=API_MAX_AGE),
+    vary_on_headers('Accept'),
+    condition(etag_func=_api_etag),
+]
+
+
+@method_decorator(API_CACHING, name='dispatch')
 class CanteenViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = CanteenSerializer
-    queryset = Canteen.objects.filter(active=True)
+    queryset = Canteen.objects.filter(active=True).prefetch_related('opening_times')
+
+    def list(self, request, *args, **kwargs):
+        # the list is the same for all requests until the canteens change
+        list_key = 'mensautils:canteens:{}'.format(get_canteen_version())
+        canteens = cache.get(list_key)
+        if canteens is None:
+            canteens = list(self.get_serializer(self.get_queryset(), many=True).data)
+            cache.set(list_key, canteens, CANTEEN_LIST_CACHE_TIMEOUT)
+        return Response(canteens)
 
     @action(detail=True)
     def today(self, request, pk=None):
@@ -323,3 +423,125 @@ class CanteenViewSet(viewsets.ReadOnlyModelViewSet):
         servings_tomorrow = Serving.objects.filter(date=tomorrow, canteen_id=pk, officially_deprecated=False).select_related('dish')
         serializer = ServingSerializer(servings_tomorrow, many=True)
         return Response(serializer.data)
+
+
+class ServingPagination(CursorPagination):
+    # the cursor only works without an offset if the first ordering field
+    # is unique. The primary keys increase with the date for archived
+    # servings, but backfilled servings are not sorted by date.
+    ordering = 'id'
+    page_size = 500
+    page_size_query_param = 'page_size'
+    max_page_size = 5000
+
+
+@method_decorator(API_CACHING, name='dispatch')
+class ServingViewSet(viewsets.ReadOnlyModelViewSet):
+    """Servings of several canteens and days.
+
+    The canteens are selected by the canteen parameter, which can be given
+    multiple times and defaults to all canteens. The days are selected by
+    the start and end parameters, which default to today. The servings are
+    paged by a cursor in the order they were stored.
+    """
+    serializer_class = ServingSerializer
+    pagination_class = ServingPagination
+
+    def get_queryset(self):
+        start = _get_date_param(self.request, 'start', date.today())
+        end = _get_date_param(self.request, 'end', start)
+        servings = Serving.objects.filter(
+            date__gte=start, date__lte=end,
+            officially_deprecated=False).select_related('dish')
+
+        canteen_pks = _get_canteen_pks(self.request)
+        if canteen_pks:
+            servings = servings.filter(canteen_id__in=canteen_pks)
+        return servings
+
+
+@method_decorator(API_CACHING, name='dispatch')
+class DishSearchViewSet(viewsets.ViewSet):
+    """Dishes matching the q parameter, best first.
+
+    Every word of the query has to match the beginning of a word of the
+    name or the whole word with a small typo, so unlike notification
+    patterns, dishes never match by a part of a word only. The dishes are
+    found in the index of the dish matcher. If any of the canteen, start
+    and end parameters is given, only dishes served in those canteens and
+    days are returned, together with their servings. The number of results
+    is set by limit.
+    """
+    def list(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'A search query is required.'})
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_DEFAULT_RESULTS))
+        except ValueError:
+            raise ValidationError({'limit': 'The limit has to be a number.'})
+        limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+        start = _get_date_param(request, 'start', None)
+        end = _get_date_param(request, 'end', None)
+        canteen_pks = _get_canteen_pks(request)
+
+        filtered = start is not None or end is not None or bool(canteen_pks)
+        served = {}
+        allowed_pks = None
+        if filtered:
+            servings = Serving.objects.filter(officially_deprecated=False)
+            if start is not None:
+                servings = servings.filter(date__gte=start)
+            if end is not None:
+                servings = servings.filter(date__lte=end)
+            if canteen_pks:
+                servings = servings.filter(canteen_id__in=canteen_pks)
+            allowed_pks = set(servings.values_list('dish_id', flat=True).distinct())
+
+        Dish.sync_matcher()
+        matches = dish_matcher.search(query, SEARCH_MIN_RATIO, limit, allowed_pks)
+        if filtered:
+            for dish_pk, day, canteen_pk in servings.filter(
+                    dish_id__in=[pk for pk, _ in matches]).order_by(
+                    'date', 'canteen_id').values_list('dish_id', 'date', 'canteen_id'):
+                served.setdefault(dish_pk, []).append({'date': day, 'canteen': canteen_pk})
+
+        dishes = Dish.objects.in_bulk([pk for pk, _ in matches])
+        results = []
+        for pk, score in matches:
+            if pk not in dishes:
+                # deleted by another process
+                dish_matcher.discard(pk)
+                continue
+            result = {
+                'id': pk,
+                'name': dishes[pk].name,
+                'vegetarian': dishes[pk].vegetarian,
+                'vegan': dishes[pk].vegan,
+                'score': score,
+            }
+            if filtered:
+                result['servings'] = served.get(pk, [])
+            results.append(result)
+        return Response({'results': results})
+
+
+def _get_date_param(request: HttpRequest, name: str,
+                    default: Optional[date]) -> Optional[date]:
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ValidationError({name: 'Dates have to be given as YYYY-MM-DD.'})
+    return day
+
+
+def _get_canteen_pks(request: HttpRequest) -> List[int]:
+    try:
+        return [int(canteen) for canteen in request.query_params.getlist('canteen')]
+    except ValueError:
+        raise ValidationError({'canteen': 'Canteen ids have to be numbers.'})
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 """Fetch and display canteen plans."""
 import re
-import requests
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from datetime import datetime, time
 from decimal import Decimal
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+from mensautils.parser import http
 from mensautils.parser.canteen_result import CanteenResult, Serving
+from mensautils.parser.soup import make_soup
+
+# the day entries and the opening times are the only parts of the page used
+PLAN_PARTS = SoupStrainer('div', id=re.compile(r'^(entry-|openings$)'))
 
 
 WEEKDAYS = {
@@ -32,13 +36,25 @@ SHORT_WEEKDAY_NAMES = {
 }
 
 
-def get_canteen_data(english: bool = False) -> CanteenResult:
-    """Get information about canteen."""
-    url = f'https://desy.myalsterfood.de/{"en" if english else "de"}/'
+def get_canteen_data(english: bool = False,
+                     cache: Optional[http.FetchCache] = None) -> CanteenResult:
+    """Get information about canteen.
 
-    response = requests.get(url)
+    Raises http.NotModified if a cache is given and the page did not change.
+    """
+    response, = http.get_pages([plan_url(english)], cache)
     response.encoding = response.apparent_encoding
-    week_plan = response.text
+    return parse_plan(response.text, english=english)
+
+
+def plan_url(english: bool = False) -> str:
+    """Get the URL of the week plan."""
+    return f'https://desy.myalsterfood.de/{"en" if english else "de"}/'
+
+
+def parse_plan(plan: str, english: bool = False) -> CanteenResult:
+    """Parse the servings and opening times from a week plan."""
+    week_plan = make_soup(plan, PLAN_PARTS)
 
     servings = _parse_full_plan(week_plan, english=english)
     opening_times = _parse_opening_times(week_plan, english=english)
@@ -46,10 +62,9 @@ def get_canteen_data(english: bool = False) -> CanteenResult:
     return CanteenResult(opening_times, servings)
 
 
-def _parse_opening_times(plan: str, english: bool = False) -> Dict[int, Tuple[time, time]]:
+def _parse_opening_times(parsed_plan: BeautifulSoup,
+                         english: bool = False) -> Dict[int, Tuple[time, time]]:
     """Parse opening times from a plan."""
-    parsed_plan = BeautifulSoup(plan, 'html.parser')
-
     openings_div = parsed_plan.find('div', {'id': 'openings'})
     openings_strings = openings_div.find('p').strings
     for string in openings_strings:
@@ -63,16 +78,14 @@ def _parse_opening_times(plan: str, english: bool = False) -> Dict[int, Tuple[ti
     return _extract_opening_times([opening_string])
 
 
-def _parse_full_plan(plan: str, english: bool = False) -> List[Serving]:
+def _parse_full_plan(parsed_plan: BeautifulSoup, english: bool = False) -> List[Serving]:
     """Parse the plan for all dates and all servings."""
-    parsed_plan = BeautifulSoup(plan, 'html.parser')
-
     servings = []
     days = parsed_plan.find_all('div', {'class': 'entry'})
     for day in days:
         try:
             date_string = day.attrs['id']
-            plan_date = datetime.strptime(date_string, 'entry-%Y-%m-%d')
+            plan_date = datetime.strptime(date_string, 'entry-%Y-%m-%d').date()
 
             items = day.find_all('table', {'class': 'entry'})
             parsed_items =  [_parse_item(plan_date, item, english=english) for item in items]
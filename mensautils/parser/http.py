@@ -0,0 +1,156 @@
+"""HTTP access shared by the canteen parsers."""
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# connect and read timeout in seconds
+TIMEOUT = (10, 30)
+
+# maximum number of pooled connections kept per host
+POOL_MAXSIZE = 10
+
+# etag, last modified and content hash of a fetched page
+Validators = Tuple[str, str, str]
+
+_sessions = {}  # type: Dict[str, requests.Session]
+_sessions_lock = threading.Lock()
+
+# transfers recorded by the current thread
+_local = threading.local()
+
+
+def get_session(url: str) -> requests.Session:
+    """Get the pooled session used for all requests to the host of url."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+    return session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Send a GET request using the session of the host."""
+    kwargs.setdefault('timeout', TIMEOUT)
+    transfers = getattr(_local, 'transfers', None)
+    if transfers is None:
+        return get_session(url).get(url, **kwargs)
+
+    start = time.perf_counter()
+    response = get_session(url).get(url, **kwargs)
+    transfers.requests += 1
+    transfers.bytes += len(response.content)
+    transfers.seconds += time.perf_counter() - start
+    return response
+
+
+class Transfers:
+    """Requests sent, bytes downloaded and seconds spent waiting for them."""
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+
+@contextmanager
+def record_transfers() -> Iterator[Transfers]:
+    """Record the requests sent by the current thread."""
+    previous = getattr(_local, 'transfers', None)
+    _local.transfers = Transfers()
+    try:
+        yield _local.transfers
+    finally:
+        _local.transfers = previous
+
+
+class NotModified(Exception):
+    """None of the pages of a source changed since they were last fetched."""
+
+
+class FetchCache:
+    """Validators of previously fetched pages, keyed by url."""
+    def __init__(self, entries: Optional[Dict[str, Validators]] = None):
+        self.entries = dict(entries or {})
+        # entries which changed while fetching
+        self.updated = {}  # type: Dict[str, Validators]
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Validators]:
+        with self._lock:
+            return self.entries.get(url)
+
+    def copy(self) -> 'FetchCache':
+        """Get a cache with the same entries, whose updates are kept apart."""
+        with self._lock:
+            return FetchCache(self.entries)
+
+    def merge(self, other: 'FetchCache'):
+        """Take over the updates of a copy."""
+        with self._lock:
+            self.entries.update(other.updated)
+            self.updated.update(other.updated)
+
+    def update(self, url: str, response: requests.Response) -> str:
+        """Store the validators of a response and return its content hash."""
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        validators = (response.headers.get('ETag', ''),
+                      response.headers.get('Last-Modified', ''),
+                      content_hash)
+        with self._lock:
+            self.entries[url] = validators
+            self.updated[url] = validators
+        return content_hash
+
+
+def get_pages(urls: List[str], cache: Optional[FetchCache] = None) -> List[requests.Response]:
+    """Fetch all pages of a source.
+
+    With a cache, conditional requests are sent and NotModified is raised if
+    none of the pages changed. If only some of them changed, the unchanged
+    ones are requested again without validators as their content is needed
+    as well.
+    """
+    if cache is None:
+        return [get(url) for url in urls]
+
+    responses = {}
+    unchanged = 0
+    for url in urls:
+        headers = {}
+        cached = cache.get(url)
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = get(url, headers=headers)
+        if response.status_code == 304:
+            unchanged += 1
+            continue
+
+        responses[url] = response
+        content_hash = cache.update(url, response)
+        if cached and cached[2] == content_hash:
+            unchanged += 1
+
+    if unchanged == len(urls):
+        raise NotModified()
+
+    for url in urls:
+        if url not in responses:
+            responses[url] = get(url)
+            cache.update(url, responses[url])
+
+    return [responses[url] for url in urls]
@@ -0,0 +1,21 @@
+"""Build the parse trees of the fetched pages."""
+from typing import Optional
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+except ImportError:
+    # the slower parser of the standard library is always available
+    BACKEND = 'html.parser'
+else:
+    BACKEND = 'lxml'
+
+
+def make_soup(markup: str, parse_only: Optional[SoupStrainer] = None) -> BeautifulSoup:
+    """Parse a page with the configured backend.
+
+    If parse_only is given, only the elements it matches are built, along
+    with their descendants.
+    """
+    return BeautifulSoup(markup, BACKEND, parse_only=parse_only)
@@ -2,14 +2,15 @@
 """Fetch and display canteen plans."""
 import json
 import re
-import requests
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from datetime import date, datetime, time, timedelta
 from decimal import Decimal
-from typing import Dict, List, Tuple
+from typing import Collection, Dict, List, Optional, Tuple
 
+from mensautils.parser import http
 from mensautils.parser.canteen_result import CanteenResult, Serving
+from mensautils.parser.soup import make_soup
 
 WEEKDAYS = {
     'Montag': 1,
@@ -28,30 +29,75 @@ WEEKDAYS = {
     'Sunday': 7,
 }
 
+# only the canteen sections and the location elements holding the opening
+# times are used from the plan pages
+SECTIONS = SoupStrainer(attrs={'data-location-id': True})
+LOCATIONS = SoupStrainer(attrs={'data-location': True})
 
-def get_canteen_data(canteen_number: int, english: bool = False) -> CanteenResult:
+
+def get_canteen_data(canteen_number: int, english: bool = False,
+                     cache: Optional[http.FetchCache] = None) -> CanteenResult:
     """Get information about canteen."""
+    return get_canteens_data(
+        [canteen_number], english=english, cache=cache)[canteen_number]
+
+
+def get_canteens_data(canteen_numbers: Collection[int], english: bool = False,
+                      cache: Optional[http.FetchCache] = None) -> Dict[int, CanteenResult]:
+    """Get information about multiple canteens.
+
+    The plans of all canteens are contained in the same pages, so each page
+    is only fetched and parsed once for all requested canteens.
+
+    Raises http.NotModified if a cache is given and the pages did not change.
+    """
+    today_response, next_day_response = http.get_pages(
+        list(plan_urls(english)), cache)
+    today_servings = parse_day_plan(today_response.text, canteen_numbers)
+    next_day_servings = parse_day_plan(next_day_response.text, canteen_numbers)
+    opening_times = parse_opening_times(
+        today_response.text, canteen_numbers, english=english)
+
+    results = {}
+    for canteen_number in canteen_numbers:
+        results[canteen_number] = CanteenResult(
+            opening_times[canteen_number],
+            today_servings[canteen_number] + next_day_servings[canteen_number])
+
+    return results
+
+
+def plan_urls(english: bool = False) -> Tuple[str, str]:
+    """Get the URLs of the plans of today and the next day."""
     base_url = 'https://www.stwhh.de/speiseplan/'
     if english:
         base_url = 'https://www.stwhh.de/en/menu/'
+    return base_url, base_url + '?t=next_day'
 
-    today_url = base_url
-    today_plan = requests.get(today_url).text
-    next_day_url = base_url + '?t=next_day'
-    next_day_plan = requests.get(next_day_url).text
 
-    servings = _parse_day_plan(today_plan, canteen_number) + _parse_day_plan(next_day_plan, canteen_number)
-
-    opening_times = _parse_opening_times(today_plan, canteen_number, english=english)
+def _find_by_number(parsed_plan: BeautifulSoup, attribute: str) -> Dict[int, Tag]:
+    """Map the numeric values of an attribute to the first element carrying it."""
+    elements = {}
+    for element in parsed_plan.find_all(attrs={attribute: True}):
+        try:
+            number = int(element.attrs[attribute])
+        except ValueError:
+            continue
+        elements.setdefault(number, element)
+    return elements
 
-    return CanteenResult(opening_times, servings)
 
+def parse_opening_times(plan: str, canteen_numbers: Collection[int],
+                        english: bool = False) -> Dict[int, Dict[int, Tuple[time, time]]]:
+    """Parse the opening times of some canteens from a plan."""
+    locations = _find_by_number(make_soup(plan, LOCATIONS), 'data-location')
+    return {canteen_number: _parse_location_openings(
+                locations.get(canteen_number), english=english)
+            for canteen_number in canteen_numbers}
 
-def _parse_opening_times(plan: str, canteen_number: int, english: bool = False) -> Dict[int, Tuple[time, time]]:
-    """Parse opening times from a plan."""
-    parsed_plan = BeautifulSoup(plan, 'html.parser')
 
-    location = parsed_plan.find(attrs={'data-location': canteen_number})
+def _parse_location_openings(location: Optional[Tag], english: bool = False) -> Dict[int, Tuple[time, time]]:
+    """Parse opening times from the location element of a canteen."""
     if not location:
         return {}
     opening_times_str = location.attrs['data-openings']
@@ -93,11 +139,15 @@ def _parse_opening_times(plan: str, canteen_number: int, english: bool = False)
     return opening_times_parsed
 
 
-def _parse_day_plan(plan: str, canteen_number: int) -> List[Serving]:
-    """Parse a day plan for its date and all servings."""
-    parsed_plan = BeautifulSoup(plan, 'html.parser')
+def parse_day_plan(plan: str, canteen_numbers: Collection[int]) -> Dict[int, List[Serving]]:
+    """Parse the servings of some canteens from a day plan."""
+    sections = _find_by_number(make_soup(plan, SECTIONS), 'data-location-id')
+    return {canteen_number: _parse_canteen_section(sections.get(canteen_number))
+            for canteen_number in canteen_numbers}
+
 
-    canteen_section = parsed_plan.find(attrs={'data-location-id': canteen_number})
+def _parse_canteen_section(canteen_section: Optional[Tag]) -> List[Serving]:
+    """Parse the section of a day plan belonging to a single canteen."""
     if not canteen_section:
         return []
     menus = canteen_section.find_all(attrs={'class': 'menue-tile'})